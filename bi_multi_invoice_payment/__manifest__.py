@@ -21,7 +21,8 @@
         which will automatically load all the open, unpaid invoices/bills to the lines. If invoices
         with different partners are selected, the payment cannot be grouped.
 
-        DISCLAIMER: Currently, we do not support multi-currency payments.
+        All the invoices/bills of a register must share the same currency, which can
+        be a foreign currency: the payments are then registered in that currency.
     """,
 
     'author': "Bassam Infotech LLP",
@@ -35,8 +36,10 @@
     'images': ['static/description/multi_invoice_payment_cover.png'],
     'currency': 'USD',
     'data': [
+        'data/ir_cron.xml',
         'views/account_payment_register.xml',
         'views/payment_discount.xml',
+        'views/payment_register_perf.xml',
         'views/account_batch_payment.xml',
         'views/menus.xml',
         'security/ir.model.access.csv'
@@ -9,6 +9,10 @@
 #############################################################################
 
 from . import account_move
+from . import account_move_open_item
 from . import account_payment
+from . import account_payment_allocation
+from . import account_batch_payment
 from . import account_custom_payment_register
 from . import payment_discount
+from . import payment_register_perf
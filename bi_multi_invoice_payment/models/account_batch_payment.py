@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import logging
+from datetime import date
+
+from odoo import _, api, models
+from odoo.exceptions import UserError
+
+_logger = logging.getLogger(__name__)
+
+
+class AccountBatchPayment(models.Model):
+    _inherit = 'account.batch.payment'
+
+    _sql_constraints = [
+        # A partial unique constraint: only the draft deposits must have
+        # different numbers in a journal.
+        ('draft_deposit_uniq',
+         "EXCLUDE (journal_id WITH =, name WITH =) WHERE (state = 'draft')",
+         "A draft batch deposit with this deposit number already exists in "
+         "this journal."),
+    ]
+
+    def init(self):
+        '''Stop the installation or update while draft batch deposits share
+        their journal and deposit number: the draft_deposit_uniq constraint
+        can't be added on them. They are listed so they can be merged by hand,
+        they are not merged automatically as some may have been created on
+        purpose.
+
+        '''
+        super(AccountBatchPayment, self).init()
+        cr = self.env.cr
+        cr.execute("""
+            SELECT journal_id, name, array_agg(id ORDER BY id)
+              FROM account_batch_payment
+             WHERE state = 'draft' AND name IS NOT NULL
+          GROUP BY journal_id, name
+            HAVING COUNT(*) > 1
+        """)
+        duplicates = cr.fetchall()
+        if duplicates:
+            raise UserError(_(
+                "Some draft batch deposits share their journal and deposit "
+                "number, please merge them before updating the module:\n%s"
+            ) % '\n'.join(
+                _("- journal %(journal)s, deposit %(name)s: batches %(ids)s") % {
+                    'journal': journal_id, 'name': name,
+                    'ids': ', '.join(str(batch_id) for batch_id in batch_ids)}
+                for journal_id, name, batch_ids in duplicates))
+
+    @api.model
+    def _get_or_create_draft_deposit(self, journal, deposit_number, payment_method):
+        '''Find the draft batch deposit of the journal with the given deposit
+        number, creating it if it doesn't exist.
+
+        By some odoo core validation is not possible create a batch payment
+        with this module bi_multi_invoice_payment, so the batch deposit is
+        inserted directly in the database. The draft_deposit_uniq constraint
+        makes the insert of a concurrent transaction wait for the first one:
+        it then fails with a serialization error, retried by odoo, and the
+        retry finds the batch of the first transaction. A search done before
+        the insert can't see that batch under REPEATABLE READ, so the
+        constraint is the only guarantee against duplicates.
+
+        '''
+        domain = [('journal_id', '=', journal.id),
+                  ('name', '=', deposit_number),
+                  ('state', '=', 'draft')]
+        batch = self.search(domain, limit=1)
+        if batch:
+            return batch
+        self.flush()
+        cr = self.env.cr
+        cr.execute('''
+            INSERT INTO account_batch_payment(
+                batch_type,
+                date,
+                state,
+                journal_id,
+                payment_method_id,
+                name,
+                create_uid, create_date, write_uid, write_date)
+            VALUES ('inbound', %s, 'draft', %s, %s, %s,
+                    %s, now() at time zone 'UTC', %s, now() at time zone 'UTC')
+            ON CONFLICT DO NOTHING
+            RETURNING id''', (date.today(), journal.id, payment_method.id,
+                              deposit_number, self.env.uid, self.env.uid))
+        row = cr.fetchone()
+        if row:
+            return self.browse(row[0])
+        batch = self.search(domain, limit=1)
+        if not batch:
+            raise UserError(_("The batch deposit %s could not be created, please try again.")
+                            % deposit_number)
+        return batch
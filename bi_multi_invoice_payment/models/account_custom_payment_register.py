@@ -8,15 +8,34 @@
 #
 #############################################################################
 
+import base64
+import csv
+import io
 import logging
+import math
+import re
+import threading
+
+from lxml import etree
 
 from odoo import _, api, fields, models
-from odoo.exceptions import UserError
+from odoo.exceptions import UserError, ValidationError
+from odoo.tools import split_every
 from collections import defaultdict
 from odoo.osv import expression
 
+from .payment_register_perf import perf_span
+
 _logger = logging.getLogger(__name__)
 
+# Number of remittance rows resolved and created at once by the import.
+REMITTANCE_IMPORT_CHUNK_SIZE = 1000
+# An amount of the remittance files once the thousands separators removed,
+# and the groups of digits split by the thousands separators.
+REMITTANCE_AMOUNT_RE = re.compile(r'^[+-]?\d+(\.\d+)?$')
+REMITTANCE_FIRST_GROUP_RE = re.compile(r'^[+-]?\d{1,3}$')
+REMITTANCE_GROUP_RE = re.compile(r'^\d{3}$')
+
 # TODO: REMOVE THIS SHIT
 MAP_INVOICE_TYPE_PARTNER_TYPE = {
     'out_invoice': 'customer',
@@ -65,19 +84,43 @@ class AccountCustomRegisterPayment(models.Model):
     company_currency_id = fields.Many2one(
         related='company_id.currency_id', string='Company Currency',
         readonly=True, store=True, help='Utility field to express amount currency')
+    currency_id = fields.Many2one(
+        'res.currency', string='Currency', compute='_compute_currency_id',
+        store=True, help="Currency of the invoices/bills and of the payments.")
     total_invoice_amount = fields.Monetary(
-        currency_field="company_currency_id",
-        compute='_compute_total_invoice_amount')
+        currency_field="currency_id",
+        compute='_compute_totals', store=True)
+    total_discount_residual = fields.Monetary(
+        string='Total Due of Discount Lines',
+        currency_field="currency_id",
+        compute='_compute_totals', store=True)
+    total_discount_balance = fields.Monetary(
+        string='Total Discount Balance',
+        currency_field="currency_id",
+        compute='_compute_totals', store=True)
     invoice_type = fields.Selection([
         ('out_invoice', 'Customer Invoice'),
         ('in_invoice', 'Vendor Bill'),
     ], default='out_invoice')
     state = fields.Selection([('draft', 'Draft'),
+                              ('queued', 'Queued'),
+                              ('failed', 'Failed'),
                               ('posted', 'Posted')], default='draft'
     )
+    job_error = fields.Text(string='Processing Error', readonly=True, copy=False)
+    job_progress = fields.Float(string='Progress', compute='_compute_job_progress')
     register_line_ids = fields.One2many('account.payment.register.line',
                                         'account_payment_register_id', string='Lines')
+    allocation_ids = fields.One2many('account.payment.allocation',
+                                     'register_id', string='Allocations',
+                                     readonly=True, copy=False)
     is_initial = fields.Boolean(string='Is Initial?', default=False)
+    import_file = fields.Binary(string='Remittance File', copy=False,
+                                help="CSV file with the columns reference, amount"
+                                     " and optionally discount, or a CAMT.054 XML file.")
+    import_filename = fields.Char(copy=False)
+    has_more_invoices = fields.Boolean(
+        help="The partner have more open invoices than the ones loaded in the lines.")
     deposit_number = fields.Char(required=True)
     check_number = fields.Char(required=True)
     is_authorized_percent = fields.Boolean(
@@ -85,46 +128,98 @@ class AccountCustomRegisterPayment(models.Model):
     )
     total_balance = fields.Float(compute="compute_total_balance", store=True)
 
-    @api.depends('total_balance', 'partner_id')
+    @api.depends('total_balance', 'partner_id', 'company_id',
+                 'register_line_ids.discount')
     def compute_authorized(self):
         '''Check if the logged user is authorized.
         TODO: Use a role for this validation
 
         '''
+        PaymentDiscount = self.env['payment.discount']
         for record in self:
-            record.is_authorized_percent = True
-            # update_lines(record)
-            if False: # nuevo_grupo.id in self.env.user.groups_id
-                record.is_authorized_percent = True
-            else:
-                max_disc = self.env['payment.discount'].search(
-                    [], limit=1, order="id desc")
-                any_discount_line = self.register_line_ids.filtered(
-                    lambda x: x.discount)
-                # * 100 because the widget percent in the view automatically
-                # multiply by 100 then in the logic don't put this multiplication
-                # and is necessary here for the comparison.
-                if (max_disc.max_payment_discount < (record.total_balance * 100)
-                    and any_discount_line):
-                    # update_lines(record, False)
-                    record.is_authorized_percent =  False
-
-    @api.depends('register_line_ids.amount_payment')
+            max_disc = PaymentDiscount._get_max_payment_discount(
+                record.company_id.id)
+            any_discount_line = any(
+                line.discount for line in record.register_line_ids)
+            # * 100 because the widget percent in the view automatically
+            # multiply by 100 then in the logic don't put this multiplication
+            # and is necessary here for the comparison.
+            record.is_authorized_percent = not (
+                any_discount_line and max_disc < (record.total_balance * 100))
+
+    @api.depends('register_line_ids.currency_id', 'company_id')
+    def _compute_currency_id(self):
+        for record in self:
+            record.currency_id = (record.register_line_ids.currency_id[:1]
+                                  or record.company_id.currency_id)
+
+    @api.depends('register_line_ids.processed')
+    def _compute_job_progress(self):
+        for record in self:
+            lines = record.register_line_ids
+            processed = len(lines.filtered('processed'))
+            record.job_progress = processed * 100.0 / len(lines) if lines else 0.0
+
+    @api.depends('register_line_ids.amount_payment',
+                 'register_line_ids.amount_balance',
+                 'register_line_ids.amount_residual',
+                 'register_line_ids.discount')
+    def _compute_totals(self):
+        '''Compute the running aggregates of the lines (total payment, total
+        due and total balance of the discount lines) in one pass over the
+        lines, on the values already in the cache.
+
+        '''
+        for record in self:
+            total_invoice_amount = total_residual = total_discount = 0.0
+            for line in record.register_line_ids:
+                total_invoice_amount += line.amount_payment
+                if line.discount:
+                    total_residual += line.amount_residual
+                    total_discount += line.amount_balance
+            record.total_invoice_amount = total_invoice_amount
+            record.total_discount_residual = total_residual
+            record.total_discount_balance = total_discount
+
+    @api.depends('total_discount_residual', 'total_discount_balance')
     def compute_total_balance(self):
         '''Calculate the total balance percent.'''
         for rec in self:
-            total_residual = sum(rec.register_line_ids.filtered(
-                lambda l:l.discount).mapped('amount_residual'))
-            total_discount = sum(rec.register_line_ids.filtered(
-                lambda l:l.discount).mapped('amount_balance'))
+            total_residual = rec.total_discount_residual
+            total_discount = rec.total_discount_balance
             rec.total_balance = 0
             if total_residual > 0 and total_discount > 0:
                 rec.total_balance = round(total_discount / total_residual, 6)
 
     def autofill_lines(self):
-        '''Fill the pay amount with the current amount residual in the line.'''
-        for line in self.register_line_ids:
-            line.amount_payment = round(line.amount_residual, 2)
+        '''Fill the pay amount with the current amount residual in the line.
+        The amounts are rounded with the invoice currency and all the lines
+        are updated by one UPDATE ... FROM (VALUES ...) query, then marked as
+        modified so the dependent fields (the balance percentages and the
+        totals of the registers) are recomputed once for all the lines.
+
+        '''
+        lines = self.register_line_ids
+        if not lines:
+            return True
+        fnames = ['amount_payment', 'amount_balance']
+        lines.flush(fnames)
+        values = []
+        for line in lines:
+            currency = line.currency_id or line.company_currency_id
+            amount_payment = currency.round(line.amount_residual)
+            values.append((line.id, amount_payment, line.amount_residual - amount_payment))
+        self.env.cr.execute("""
+            UPDATE account_payment_register_line line
+               SET amount_payment = value.amount_payment,
+                   amount_balance = value.amount_balance,
+                   write_uid = %%s,
+                   write_date = NOW() AT TIME ZONE 'UTC'
+              FROM (VALUES %s) AS value(id, amount_payment, amount_balance)
+             WHERE line.id = value.id
+        """ % ', '.join(['%s'] * len(values)), [self.env.uid] + values)
+        lines.invalidate_cache(fnames + ['write_uid', 'write_date'], lines.ids)
+        lines.modified(fnames)
         return True
         # return {
         #     'name': _('Multi-Invoice Payment'),
@@ -136,13 +231,53 @@ class AccountCustomRegisterPayment(models.Model):
         #     'type': 'ir.actions.act_window',
         #     'res_id': self.id}
 
+    def _get_open_invoices_domain(self):
+        '''Domain of the open invoices loaded in the lines for the partner, on
+        the open items (account.move.open.item).'''
+        self.ensure_one()
+        return [
+            ('company_id', '=', self.env.company.id),
+            ('partner_id', '=', self.partner_id.id),
+            ('move_type', '=', 'out_invoice'),
+        ]
+
+    def _get_open_invoices_page_size(self):
+        '''Max number of open invoices loaded at once in the lines, 0 means
+        no limit. Set by the bi_multi_invoice_payment.open_invoice_page_size
+        system parameter.
+
+        '''
+        return int(self.env['ir.config_parameter'].sudo().get_param(
+            'bi_multi_invoice_payment.open_invoice_page_size', 500))
+
+    def _load_invoice_lines(self, domain, limit=None):
+        '''Read the open invoices matching the domain from the open items,
+        ordered by due date, and prepare the lines values. The invoice amounts
+        shown in the lines are then read with one query by id.
+
+        :param domain: A domain on account.move.open.item.
+        :return: A tuple (lines commands, invoice ids, has more invoices).
+        '''
+        items = self.env['account.move.open.item'].search(
+            domain, limit=limit and limit + 1)
+        has_more = bool(limit) and len(items) > limit
+        invoice_ids = (items[:limit] if limit else items).mapped('move_id').ids
+        self.env['account.move'].browse(invoice_ids).read(
+            ['amount_total', 'amount_residual'])
+        return self._prepare_invoice_line_values(invoice_ids), invoice_ids, has_more
+
+    @api.model
+    def _prepare_invoice_line_values(self, invoice_ids):
+        '''Prepare the commands creating a line for each invoice.'''
+        return [(0, 0, {'move_id': invoice_id, 'amount_payment': 0.0})
+                for invoice_id in invoice_ids]
+
     @api.onchange('partner_id')
     def _onchange_partner_id(self):
-        """ Prepare the dict of values to balance the move.
+        """ Load the open invoices of the partner in the lines.
+        The invoices are read by pages (see _get_open_invoices_page_size), the
+        next ones are added with the Load More button.
 
-            :param recordset move: the account.move to link the move line
-            :param dict move: a dict of vals of a account.move which will be created later
-            :param float amount: the amount of transaction that wasn't already reconciled
         TODO: Remove this method and implement a compute field who fill the lines
         field using the partner.
 
@@ -152,30 +287,18 @@ class AccountCustomRegisterPayment(models.Model):
             # add the open invoices against the partner
             if not record.is_initial:
                 if record.partner_id:
-                    partner = record.partner_id.id
-                    invoice_ids = self.env['account.move'].search([
-                        ('partner_id', '=', record.partner_id.id),
-                        ('move_type', '=', 'out_invoice'),
-                        ('state', '=', 'posted'),
-                        ('company_id', '=', self.env.company.id),
-                        ('amount_residual', '>', 0)
-                    ], order='invoice_date_due, date')
-                    line_values = []
-                    for each_move in invoice_ids:
-                        values = (0, 0, {'move_id': each_move.id,
-                                         'amount_payment': 0.0,
-                                         'partner_id': each_move.partner_id.id})
-                        line_values.append(values)
-                    # Write the new values after unlinking existing lines
-                    record.register_line_ids.unlink()
-                    record.write({'register_line_ids': line_values,
-                                  'invoice_ids': [(6, 0, invoice_ids.ids)],
-                                  'partner_id': partner,
-                                  'group_payment': True})
+                    line_values, invoice_ids, has_more = record._load_invoice_lines(
+                        record._get_open_invoices_domain(),
+                        limit=record._get_open_invoices_page_size())
+                    # Replace the existing lines with the new ones
+                    record.update({'register_line_ids': [(5, 0, 0)] + line_values,
+                                   'invoice_ids': [(6, 0, invoice_ids)],
+                                   'has_more_invoices': has_more,
+                                   'group_payment': True})
                 else:
-                    record.register_line_ids.unlink()
-                    record.write({
-                        # 'partner_id': False,
+                    record.update({
+                        'register_line_ids': [(5, 0, 0)],
+                        'has_more_invoices': False,
                         'is_initial': False,
                         'group_payment': False,
                     })
@@ -185,24 +308,25 @@ class AccountCustomRegisterPayment(models.Model):
                 record.is_initial = False
                 active_ids = self._context.get('active_ids')
                 if active_ids:
-                    move_ids = self.env['account.move'].search([
-                        ('id', 'in', active_ids)
-                    ], order='invoice_date_due, date')
-                    line_values = []
-                    for each_move in move_ids:
-                        values = (0, 0, {'move_id': each_move.id,
-                                         'amount_payment': 0.0,
-                                         'partner_id': each_move.partner_id.id})
-                        line_values.append(values)
-                    record.register_line_ids = line_values
-
-    @api.depends('register_line_ids.amount_payment')
-    def _compute_total_invoice_amount(self):
-        for record in self:
-            total_invoice_amount = 0
-            for each_line in record.register_line_ids:
-                total_invoice_amount += each_line.amount_payment
-            record.total_invoice_amount = total_invoice_amount
+                    # The selected documents are read from account.move: they
+                    # are not all in the open items (refunds, receipts).
+                    invoices = self.env['account.move'].search_read(
+                        [('id', 'in', active_ids)], ['amount_total', 'amount_residual'],
+                        order='invoice_date_due, date')
+                    record.register_line_ids = record._prepare_invoice_line_values(
+                        [invoice['id'] for invoice in invoices])
+
+    def load_more_invoices(self):
+        '''Add the next page of open invoices of the partner to the lines.'''
+        for record in self.filtered(lambda r: r.partner_id and r.has_more_invoices):
+            domain = record._get_open_invoices_domain() + [
+                ('move_id', 'not in', record.register_line_ids.move_id.ids)]
+            line_values, invoice_ids, has_more = record._load_invoice_lines(
+                domain, limit=record._get_open_invoices_page_size())
+            record.write({'register_line_ids': line_values,
+                          'invoice_ids': [(4, invoice_id) for invoice_id in invoice_ids],
+                          'has_more_invoices': has_more})
+        return True
 
     @api.model
     def default_get(self, fields):
@@ -212,35 +336,10 @@ class AccountCustomRegisterPayment(models.Model):
             return rec
         # Set is_initial as true to not trigger onchange changes for the first time.
         rec['is_initial'] = True
-        invoices = self.env['account.move'].browse(active_ids)
-        partner_ids = invoices.mapped('partner_id')
-        # Set group payment as false if invoices with different partners are selected
-        if len(partner_ids) > 1:
-            rec['group_payment'] = False
-            raise UserError(
-                _("You can only register payments for the same client."))
-        else:
-            rec['partner_id'] = partner_ids.id
-        # Check all invoices are open
-        if any(invoice.state != 'posted' or
-               invoice.payment_state  not in ('partial','not_paid') or not
-               invoice.is_invoice() for invoice in invoices):
-            msg_err = "You can only register payments for open & not-paid"+\
-                      " invoices."
-            raise UserError(_(msg_err))
-        # Check all invoices are inbound or all invoices are outbound
-        outbound_list = [invoice.is_outbound() for invoice in invoices]
-        first_outbound = invoices[0].is_outbound()
-        if any(x != first_outbound for x in outbound_list):
-            raise UserError(_("You can only register at the same time for payment that are all inbound or all outbound"))
-        if any(inv.company_id != invoices[0].company_id for inv in invoices):
-            raise UserError(_("You can only register at the same time for payment that are all from the same company"))
-        # Check the destination account is the same
-        destination_account = invoices.line_ids.filtered(lambda line: line.account_internal_type in ('receivable', 'payable')).mapped('account_id')
-        if len(destination_account) > 1:
-            raise UserError(_('There is more than one receivable/payable account in the concerned invoices. You cannot group payments in that case.'))
+        summary = self._check_invoices(active_ids)
+        rec['partner_id'] = summary['partner_ids'][0] if summary['partner_ids'] else False
         if 'invoice_ids' not in rec:
-            rec['invoice_ids'] = [(6, 0, invoices.ids)]
+            rec['invoice_ids'] = [(6, 0, active_ids)]
         if 'journal_id' not in rec:
             rec['journal_id'] = self.env['account.journal'].search([
                 ('company_id', '=', self.env.company.id),
@@ -257,30 +356,45 @@ class AccountCustomRegisterPayment(models.Model):
             return {'domain': {'journal_id': domain_journal}}
         return {}
 
-    def _prepare_payment_vals(self, invoices):
+    def _get_lines_by_move(self):
+        '''Map each invoice/bill id to its register line.'''
+        return {line.move_id.id: line for line in self.register_line_ids}
+
+    def _prepare_payment_vals(self, invoices, lines_by_move=None):
         '''Create the payment values.
 
         :param invoices: The invoices/bills to pay. In case of multiple
             documents, they need to be grouped by partner, bank, journal and
             currency.
+        :param lines_by_move: The register lines by invoice id, as returned
+            by _get_lines_by_move(). Computed if not given.
         :return: The payment values as a dictionary.
 
         '''
-        amount = self.total_invoice_amount
+        if lines_by_move is None:
+            lines_by_move = self._get_lines_by_move()
+        empty_line = self.env['account.payment.register.line']
         # Filtered the invoices using the lines properties discount and
         # payment amount.
         filtered_inv = []
+        allocation_vals = []
+        amount = 0.0
         for inv in invoices:
-            line = self.register_line_ids.filtered(
-                lambda l: l.move_id.id == inv.id)
+            line = lines_by_move.get(inv.id, empty_line)
             if line.discount or line.amount_payment > 0:
                 filtered_inv.append(inv)
+                amount += line.amount_payment
+                allocation_vals.append((0, 0, {
+                    'move_id': inv.id,
+                    'amount': line.amount_payment,
+                    'register_id': self.id,
+                    'register_line_id': line.id,
+                }))
         communication = ", ".join(
             i.payment_reference or i.ref or i.name for i in filtered_inv)
-        related_inv_char = str([i.id for i in filtered_inv])
         if self.group_payment:
             values = {
-                'related_inv_char': related_inv_char,
+                'allocation_ids': allocation_vals,
                 'use_bi_multi_inv_payment_module': True,
                 'deposit_number': self.deposit_number,
                 'check_number': self.check_number,
@@ -289,7 +403,7 @@ class AccountCustomRegisterPayment(models.Model):
                 'date': self.payment_date,
                 'ref': communication,
                 'payment_type': ('inbound' if amount > 0 else 'outbound'),
-                'amount': self.total_invoice_amount,
+                'amount': amount,
                 'currency_id': invoices[0].currency_id.id,
                 'partner_id': invoices[0].commercial_partner_id.id,
                 'partner_type': MAP_INVOICE_TYPE_PARTNER_TYPE[invoices[0].type_name],
@@ -297,7 +411,7 @@ class AccountCustomRegisterPayment(models.Model):
             }
         else:
             values = {
-                'related_inv_char': related_inv_char,
+                'allocation_ids': allocation_vals,
                 'use_bi_multi_inv_payment_module': True,
                 'deposit_number': self.deposit_number,
                 'check_number': self.check_number,
@@ -308,8 +422,7 @@ class AccountCustomRegisterPayment(models.Model):
                 #'invoice_ids': [(6, 0, invoices.ids)],
                 #'reconciled_invoice_ids': [(6, 0, invoice_ids)],
                 'payment_type': ('inbound' if amount > 0 else 'outbound'),
-                'amount': self.register_line_ids.filtered(
-                    lambda x : x.move_id == invoices[0]).amount_payment,
+                'amount': lines_by_move.get(invoices[0].id, empty_line).amount_payment,
                 'currency_id': invoices[0].currency_id.id,
                 'partner_id': invoices[0].commercial_partner_id.id,
                 'partner_type': MAP_INVOICE_TYPE_PARTNER_TYPE[invoices[0].type_name],
@@ -325,21 +438,118 @@ class AccountCustomRegisterPayment(models.Model):
                 invoice.partner_bank_id,
                 MAP_INVOICE_TYPE_PARTNER_TYPE[invoice.type_name])
 
-    def get_payments_vals(self):
+    @perf_span('get_payments_vals')
+    def get_payments_vals(self, lines=None):
         '''Compute the values for payments.
 
+        :param lines: The register lines to pay, all the lines if not given.
         :return: a list of payment values (dictionary).
         '''
-        grouped = defaultdict(lambda: self.env["account.move"])
-        invoices = self.invoice_ids
-        if not invoices:
-            invoices = self.register_line_ids.mapped('move_id')
+        grouped = defaultdict(list)
+        if lines is not None:
+            invoices = lines.move_id
+        else:
+            invoices = self.invoice_ids or self.register_line_ids.mapped('move_id')
         for inv in invoices:
             if self.group_payment:
-                grouped[self._get_payment_group_key(inv)] += inv
+                grouped[self._get_payment_group_key(inv)].append(inv)
             else:
-                grouped[inv.id] += inv
-        return [self._prepare_payment_vals(invoices) for invoices in grouped.values()]
+                grouped[inv.id].append(inv)
+        lines_by_move = self._get_lines_by_move()
+        AccountMove = self.env['account.move']
+        return [self._prepare_payment_vals(AccountMove.concat(*invoices), lines_by_move)
+                for invoices in grouped.values()]
+
+    @api.model
+    def _get_invoices_summary(self, move_ids):
+        '''Read with one aggregate query all the attributes of the given
+        invoices/bills needed by the validations, without loading the
+        invoices nor their journal items in the ORM.
+
+        :param move_ids: A list of account.move ids.
+        :return: A dictionary with the distinct partner_ids, currency_ids,
+            company_ids and move_types, if any document is not open
+            (not_open) and the number of receivable/payable accounts
+            (account_count).
+        :raise UserError: If there is no invoice/bill.
+
+        '''
+        if not move_ids:
+            raise UserError(_("There are no invoices/bills to pay."))
+        self.env['account.move'].flush(['partner_id', 'currency_id', 'company_id',
+                                        'move_type', 'state', 'payment_state'])
+        self.env['account.move.line'].flush(['move_id', 'account_id',
+                                             'account_internal_type'])
+        self.env.cr.execute('''
+            SELECT array_remove(array_agg(DISTINCT move.partner_id), NULL),
+                   array_remove(array_agg(DISTINCT move.currency_id), NULL),
+                   array_remove(array_agg(DISTINCT move.company_id), NULL),
+                   array_agg(DISTINCT move.move_type),
+                   COALESCE(bool_or(move.state != 'posted'
+                                    OR move.payment_state NOT IN ('partial', 'not_paid')
+                                    OR move.payment_state IS NULL), FALSE),
+                   (SELECT COUNT(DISTINCT line.account_id)
+                      FROM account_move_line line
+                     WHERE line.move_id IN %s
+                       AND line.account_internal_type IN ('receivable', 'payable'))
+              FROM account_move move
+             WHERE move.id IN %s
+        ''', [tuple(move_ids)] * 2)
+        row = self.env.cr.fetchone()
+        return {
+            'partner_ids': row[0] or [],
+            'currency_ids': row[1] or [],
+            'company_ids': row[2] or [],
+            'move_types': row[3] or [],
+            'not_open': row[4],
+            'account_count': row[5],
+        }
+
+    @api.model
+    def _check_invoices(self, move_ids, register=None):
+        '''Validate the invoices/bills with one aggregate query (see
+        _get_invoices_summary) and report all the violations together.
+
+        :param move_ids: A list of account.move ids.
+        :param register: The register paying the invoices. When not given,
+            the invoices are the ones selected to open the wizard.
+        :return: The summary of the invoices.
+
+        '''
+        summary = self._get_invoices_summary(move_ids)
+        AccountMove = self.env['account.move']
+        move_types = set(summary['move_types'])
+        errors = []
+        if register is None:
+            if len(summary['partner_ids']) > 1:
+                errors.append(_("You can only register payments for the same client."))
+            # Check all invoices are open
+            if summary['not_open'] or move_types - set(AccountMove.get_invoice_types()):
+                errors.append(_("You can only register payments for open & not-paid"
+                                " invoices."))
+            # Check all invoices are inbound or all invoices are outbound
+            outbound_types = set(AccountMove.get_outbound_types())
+            if len({move_type in outbound_types for move_type in move_types}) > 1:
+                errors.append(_("You can only register at the same time for payment that are all inbound or all outbound"))
+        else:
+            if len(summary['partner_ids']) > 1 and register.group_payment:
+                errors.append(_("You can't group payments when invoices with"
+                                " different partners are selected!"))
+            if len(summary['currency_ids']) > 1:
+                errors.append(_("You can only register at the same time for payment"
+                                " of invoices in the same currency."))
+            if len(move_types) > 1:
+                errors.append(_("You can only register at the same time for payment"
+                                " that are all inbound or all outbound"))
+        if len(summary['company_ids']) > 1:
+            errors.append(_("You can only register at the same time for payment"
+                            " that are all from the same company"))
+        # Check the destination account is the same
+        if register is None and summary['account_count'] > 1:
+            errors.append(_('There is more than one receivable/payable account in the concerned invoices. You cannot group payments in that case.'))
+        if errors:
+            raise UserError("\n".join(errors))
+        return summary
 
     def validate_invoices(self):
         '''Validate if the selected invoices meet all the needed conditions.'''
@@ -350,22 +560,9 @@ class AccountCustomRegisterPayment(models.Model):
                       " with {p} % of Total Discount."
             raise UserError(_(err_msg.format(
                 p=round(self.total_balance * 100, 2))))
-        partner_ids = self.register_line_ids.mapped('move_id.partner_id.id')
-        if len(partner_ids) > 1 and self.group_payment:
-            raise UserError(_("You can't group payments when invoices with"+\
-                              " different partners are selected!"))
-        currency_ids = self.register_line_ids.mapped('move_id.currency_id.id')
-        if len(currency_ids) > 1 or currency_ids[0] != self.env.company.currency_id.id:
-            raise UserError(_("Sorry! We do not support multi currency as of now!"))
-        move_ids = self.register_line_ids.mapped('move_id')
-        if any(inv.company_id != move_ids[0].company_id for inv in move_ids):
-            raise UserError(_("You can only register at the same time for payment"+\
-                              " that are all from the same company"))
-        move_types = set(self.register_line_ids.mapped('move_id.move_type'))
-        if len(move_types) > 1:
-            raise UserError(_("You can only register at the same time for payment"+\
-                              " that are all inbound or all outbound"))
+        self._check_invoices(self.register_line_ids.move_id.ids, register=self)
 
+    @perf_span('create_payments')
     def create_payments(self):
         '''Create payments according to the invoices.
         Having invoices with different commercial_partner_id or different type
@@ -378,25 +575,7 @@ class AccountCustomRegisterPayment(models.Model):
         '''
         # check some needed validations.
         self.validate_invoices()
-        for line in self.register_line_ids:
-            line.move_id.prepayment_amount = line.amount_payment
-            if line.discount:
-                line.credited_balance = line.amount_balance
-                line.move_id.set_complete_paid = True
-
-        payment_dict = self.get_payments_vals()
-        payments = self.env['account.payment'].create(payment_dict)
-        payments.use_bi_multi_inv_payment_module = True
-        payment_amount_filter = lambda l: l.amount_payment > 0
-        # Update the related_invoice_id field. This fields is an artificial
-        # field for store the invoices related with the payment.
-        for each_line in self.register_line_ids.filtered(payment_amount_filter):
-            each_line.move_id.related_payment_id = payments.id
-        # If grouped payment, use our methods, else use base ones
-        note_credit = self.register_line_ids.filtered(lambda x: x.discount)
-        for rec in note_credit:
-            # rec.move_id.not_update_totals = True
-            self.reverse_moves(rec.move_id.id, rec.amount_balance)
+        payments = self._create_payments_for_lines(self.register_line_ids)
         action_vals = {
             'name': _('Payments'),
             'domain': [('id', 'in', payments.ids)],
@@ -411,96 +590,433 @@ class AccountCustomRegisterPayment(models.Model):
             action_vals['view_mode'] = 'tree,form'
         return action_vals
 
-    def reverse_moves(self, move_id, amount_to_reverse):
-        '''Create the reversal movement for the invoices sets like discount
-        in the line.
+    @perf_span('create_payments_for_lines')
+    def _create_payments_for_lines(self, lines):
+        '''Create the payments and the discount credit notes of some lines
+        of the register, and mark the lines as processed.
+
+        :param lines: The account.payment.register.line to pay.
+        :return: The created account.payment.
+        '''
+        # The amounts to pay are carried by the payment allocations, the
+        # invoices are neither written nor locked here so concurrent
+        # registers using the same invoices don't compete for their rows.
+        # They are locked when the payments are posted (custom_post).
+        note_credit = lines.filtered(lambda x: x.discount)
+        for line in note_credit:
+            line.credited_balance = line.amount_balance
+        # The rates of the payments and of the credit notes, looked up once.
+        rates = self._get_currency_rates([
+            (self.currency_id, self.payment_date),
+            (self.currency_id, fields.Date.context_today(self)),
+        ])
+        payments = self.env['account.payment'].with_context(
+            payment_register_rates=rates).create(self.get_payments_vals(lines))
+        payments.use_bi_multi_inv_payment_module = True
+        self.create_discount_credit_notes(note_credit, rates=rates)
+        lines.write({'processed': True})
+        return payments
 
+    def _get_currency_rates(self, currency_dates):
+        '''Look up the rate from each currency to the company currency at
+        each date only once.
+
+        :param currency_dates: An iterable of (res.currency, date).
+        :return: A dictionary of the rates by (currency id, date).
         '''
-        reversal_instance = self.env['account.move.reversal'].create(
-            {'move_ids': [(6, 0,[move_id])],
-             'refund_method': 'refund',
-             'company_id': self.env.company.id});
-        ret = reversal_instance.reverse_moves()
-        self.update_credit_note(reversal_instance.new_move_ids,
-                                amount_to_reverse)
+        company = self.company_id or self.env.company
+        Currency = self.env['res.currency']
+        rates = {}
+        for currency, date in currency_dates:
+            if (currency.id, date) not in rates:
+                rates[currency.id, date] = Currency._get_conversion_rate(
+                    currency, company.currency_id, company, date)
+        return rates
+
+    def _get_payment_job_chunk_size(self):
+        '''Number of lines paid by transaction by the background job. Set by
+        the bi_multi_invoice_payment.payment_job_chunk_size system parameter.
+
+        '''
+        return int(self.env['ir.config_parameter'].sudo().get_param(
+            'bi_multi_invoice_payment.payment_job_chunk_size', 200)) or 200
+
+    def action_create_payments_async(self):
+        '''Queue the register to create its payments in background, by
+        chunks of lines committed separately.'''
+        for record in self:
+            record.validate_invoices()
+        self.write({'state': 'queued', 'job_error': False})
+        self.env.ref('bi_multi_invoice_payment.ir_cron_process_payment_registers')._trigger()
+        return True
+
+    def action_retry_payments(self):
+        '''Queue again a failed register, the job resumes with the lines not
+        processed yet.'''
+        self.filtered(lambda r: r.state == 'failed').write({
+            'state': 'queued', 'job_error': False})
+        self.env.ref('bi_multi_invoice_payment.ir_cron_process_payment_registers')._trigger()
         return True
 
-    def update_credit_note(self, credit_note, amount_to_reverse):
-        '''Update the credit note related to the invoice.
-        In the odoo default process the credit note use all the product
-        defined in the origin invoice but in this use case is only necessary
-        have one product with the residual value, so update the needed lines
-        and remove the unnecessaries.
+    @api.model
+    def _cron_process_payment_registers(self):
+        '''Process the queued registers, run by the "Process Payment
+        Registers" scheduled action.'''
+        for register in self.search([('state', '=', 'queued')], order='id'):
+            register._process_payment_job()
+
+    def _process_payment_job(self):
+        '''Create the payments of a queued register by chunks of lines. Each
+        chunk is committed separately so the locks on its invoices are
+        released right away and the lines already paid are kept if a later
+        chunk fails; the register is then set as failed with the error and
+        can be retried from the remaining lines.
 
         '''
-        upd_line = '''
-            Update account_move_line
-            SET quantity=1,
-                price_unit={price},
-                price_subtotal={price_sbt},
-                price_total={price_total},
-                amount_residual={residual},
-                amount_currency={amount_currency},
-                debit={debit},
-                credit={credit},
-                balance={balance}
-            WHERE id={id}
+        self.ensure_one()
+        auto_commit = not getattr(threading.current_thread(), 'testing', False)
+        chunk_size = self._get_payment_job_chunk_size()
+        RegisterLine = self.env['account.payment.register.line']
+        while True:
+            # Skip the register if another worker is processing it.
+            self.env.cr.execute("""
+                SELECT id FROM account_custom_payment_register
+                 WHERE id = %s AND state = 'queued'
+                   FOR UPDATE SKIP LOCKED
+            """, [self.id])
+            if not self.env.cr.fetchone():
+                return
+            lines = RegisterLine.search([
+                ('account_payment_register_id', '=', self.id),
+                ('processed', '=', False),
+            ], order='id', limit=chunk_size)
+            if not lines:
+                self.write({'state': 'posted'})
+                self.flush()
+                if auto_commit:
+                    self.env.cr.commit()
+                return
+            try:
+                with self.env.cr.savepoint():
+                    self._check_invoices(lines.move_id.ids, register=self)
+                    self._create_payments_for_lines(lines)
+            except Exception as e:
+                _logger.exception("Payment register %s failed", self.id)
+                self.invalidate_cache()
+                self.write({'state': 'failed', 'job_error': str(e)})
+                self.flush()
+                if auto_commit:
+                    self.env.cr.commit()
+                return
+            if auto_commit:
+                self.env.cr.commit()
+            # Release the records of the chunk from the cache.
+            RegisterLine.invalidate_cache()
+
+    @api.model
+    def _parse_remittance_amount(self, value, allow_zero=False):
+        '''Parse an amount of the remittance file. The dot and the comma are
+        both accepted as decimal separator: when both are used the last one is
+        the decimal separator, a separator used several times is a thousands
+        separator, and a single separator followed by three digits ("1,234")
+        is rejected as ambiguous. The thousands separators must split the
+        digits by groups of three and the amount must be positive.
+
+        :param allow_zero: Accept a zero amount too.
+        :raise ValueError: If the amount can't be parsed.
+        '''
+        def remove_thousands_separator(integer, separator):
+            groups = integer.split(separator)
+            if not REMITTANCE_FIRST_GROUP_RE.match(groups[0]) \
+                    or not all(REMITTANCE_GROUP_RE.match(group) for group in groups[1:]):
+                raise ValueError(value)
+            return ''.join(groups)
+
+        value = (value or '').strip().replace(' ', '')
+        amount = value
+        if ',' in amount and '.' in amount:
+            decimal = ',' if amount.rfind(',') > amount.rfind('.') else '.'
+            integer, dummy, decimals = amount.rpartition(decimal)
+            thousands = '.' if decimal == ',' else ','
+            amount = '%s.%s' % (remove_thousands_separator(integer, thousands), decimals)
+        elif ',' in amount or '.' in amount:
+            separator = ',' if ',' in amount else '.'
+            if amount.count(separator) > 1:
+                amount = remove_thousands_separator(amount, separator)
+            else:
+                integer, dummy, decimals = amount.partition(separator)
+                if len(decimals) == 3 and integer.lstrip('+-') not in ('', '0'):
+                    raise ValueError(value)
+                amount = '%s.%s' % (integer, decimals)
+        if not REMITTANCE_AMOUNT_RE.match(amount):
+            raise ValueError(value)
+        amount = float(amount)
+        if not math.isfinite(amount) or amount < 0 or (not amount and not allow_zero):
+            raise ValueError(value)
+        return amount
+
+    def _read_remittance_csv(self, data):
+        '''Yield the rows of a CSV remittance file one by one.'''
+        text = io.TextIOWrapper(io.BytesIO(data), encoding='utf-8-sig', newline='')
+        sample = text.read(4096)
+        text.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=',;\t')
+        except csv.Error:
+            dialect = csv.excel
+        reader = csv.DictReader(text, dialect=dialect)
+        reader.fieldnames = [(name or '').strip().lower() for name in reader.fieldnames or []]
+        if 'reference' not in reader.fieldnames or 'amount' not in reader.fieldnames:
+            raise UserError(_("The remittance file must have the columns reference and amount."))
+        for row in reader:
+            yield {
+                'row': reader.line_num,
+                'reference': (row.get('reference') or '').strip(),
+                'amount': row.get('amount'),
+                'discount': (row.get('discount') or '').strip().lower() in ('1', 'true', 'yes', 'x'),
+            }
+
+    def _read_remittance_camt(self, data):
+        '''Yield the referred documents of a CAMT.054 file one by one. The
+        file is parsed incrementally and each transaction is released once
+        read, so big files are read with a bounded memory.
+
         '''
-        if credit_note:
-            # Find the tax move line, then after update with 0 remove it.
-            tax_line = credit_note.line_ids.filtered(
-                lambda x: x.tax_base_amount > 0)
-            credit_line = credit_note.line_ids.filtered(
-                lambda x: x.credit > 0)
-            prod_line = credit_note.line_ids.filtered(
-                lambda x: x.product_id.name != False)
-            # Clean the quantity in all the lines 
-            credit_note.line_ids.write({'quantity': 0,
-                                        'price_unit': 0,
-                                        'price_subtotal': 0,
-                                        'price_total': 0,
-                                        'amount_residual': 0,
-                                        'debit': 0,
-                                        'credit': 0,
-                                        'balance': 0,
-                                        'tax_base_amount': 0,
-                                        'tax_ids': False})
-            if any(tax_line):
-                tax_line.unlink()
-            # Update the credit line.
-            self.env.cr.execute(upd_line.format(
-                debit=0,
-                amount_currency=(amount_to_reverse * -1),
-                credit=amount_to_reverse,
-                price=(amount_to_reverse * -1),
-                price_sbt=(amount_to_reverse * -1),
-                price_total=(amount_to_reverse * -1),
-                residual=(amount_to_reverse * -1),
-                balance=(amount_to_reverse * -1),
-                id=credit_line.id))
-            # Update the first product line
-            self.env.cr.execute(upd_line.format(
-                debit=amount_to_reverse,
-                credit=0,
-                amount_currency=amount_to_reverse,
-                price=amount_to_reverse,
-                price_sbt=amount_to_reverse,
-                price_total=amount_to_reverse,
-                residual=0,
-                balance=amount_to_reverse,
-                id=prod_line[0].id))
-            prod_line[0].product_id = False
-            prod_line[0].name = 'Discount by Client Payment'
-            credit_note.write(
-                {'line_ids': [(6, 0, [prod_line[0].id, credit_line[0].id])]})
-            credit_note.write({
-                'amount_untaxed': amount_to_reverse,
-                'amount_total': amount_to_reverse,
-                'amount_residual': amount_to_reverse,
-                'amount_untaxed_signed': amount_to_reverse * -1,
-                'amount_total_signed': amount_to_reverse * -1,
-                'amount_residual_signed': amount_to_reverse * -1,
-            })
+        def children(node, name):
+            return [child for child in node
+                    if isinstance(child.tag, str) and etree.QName(child).localname == name]
+
+        def child(node, *path):
+            for name in path:
+                found = children(node, name) if node is not None else []
+                node = found[0] if found else None
+            return node
+
+        index = 0
+        # The entities are not resolved and nothing is loaded from the
+        # network: an uploaded file must not be able to read the files of
+        # the server nor to reach other hosts.
+        events = etree.iterparse(io.BytesIO(data), events=('end',), resolve_entities=False,
+                                 no_network=True, load_dtd=False, huge_tree=False)
+        for dummy, tx in events:
+            if not isinstance(tx.tag, str) or etree.QName(tx).localname != 'TxDtls':
+                continue
+            remittance = child(tx, 'RmtInf')
+            for structured in children(remittance, 'Strd') if remittance is not None else []:
+                index += 1
+                reference = child(structured, 'RfrdDocInf', 'Nb')
+                amount = child(structured, 'RfrdDocAmt', 'RmtdAmt')
+                if amount is None:
+                    amount = child(tx, 'AmtDtls', 'TxAmt', 'Amt')
+                if amount is None:
+                    amount = child(tx, 'Amt')
+                discount = child(structured, 'RfrdDocAmt', 'DscntApldAmt', 'Amt')
+                if discount is None:
+                    discount = child(structured, 'RfrdDocAmt', 'DscntApldAmt')
+                row = {
+                    'row': index,
+                    'reference': (reference.text or '').strip() if reference is not None else '',
+                    'amount': amount.text if amount is not None else '',
+                    'discount': False,
+                }
+                if discount is not None and discount.text:
+                    try:
+                        row['discount'] = self._parse_remittance_amount(
+                            discount.text, allow_zero=True) > 0
+                    except ValueError:
+                        row['error'] = _("Invalid discount %s") % discount.text
+                yield row
+            tx.clear()
+            while tx.getprevious() is not None:
+                del tx.getparent()[0]
+
+    def _read_remittance_rows(self):
+        '''Yield the rows of the remittance file of the register.'''
+        self.ensure_one()
+        data = base64.b64decode(self.import_file)
+        filename = (self.import_filename or '').lower()
+        if filename.endswith('.xml') or data.lstrip()[:1] == b'<':
+            return self._read_remittance_camt(data)
+        return self._read_remittance_csv(data)
+
+    def _import_remittance_chunk(self, rows, imported_move_ids):
+        '''Resolve the references of a chunk of remittance rows with one
+        search_read and create their lines with one create.
+
+        :param rows: A list of rows as yielded by _read_remittance_rows().
+        :param imported_move_ids: The set of invoice ids already in the
+            register, updated with the new ones.
+        :return: A tuple (number of created lines, list of rejected rows).
+        '''
+        references = list({row['reference'] for row in rows if row['reference']})
+        moves = self.env['account.move'].search_read([
+            ('company_id', '=', self.company_id.id),
+            ('move_type', '=', self.invoice_type),
+            '|', ('name', 'in', references), ('payment_reference', 'in', references),
+        ], ['name', 'payment_reference', 'partner_id', 'state', 'payment_state',
+            'amount_residual'])
+        for move in moves:
+            move['is_open'] = (move['state'] == 'posted'
+                               and move['payment_state'] in ('not_paid', 'partial')
+                               and move['amount_residual'] > 0)
+        # The open invoices first, when several share a reference.
+        moves.sort(key=lambda move: not move['is_open'])
+        moves_by_reference = {}
+        for move in moves:
+            moves_by_reference.setdefault(move['name'], move)
+        for move in moves:
+            if move['payment_reference']:
+                moves_by_reference.setdefault(move['payment_reference'], move)
+        line_vals_list = []
+        rejected = []
+        for row in rows:
+            if row.get('error'):
+                rejected.append((row, row['error']))
+                continue
+            move = moves_by_reference.get(row['reference'])
+            try:
+                amount = self._parse_remittance_amount(row['amount'])
+            except ValueError:
+                rejected.append((row, _("Invalid amount %s") % row['amount']))
+                continue
+            if not move:
+                rejected.append((row, _("Invoice not found")))
+            elif not move['is_open']:
+                rejected.append((row, _("Invoice not open")))
+            elif move['id'] in imported_move_ids:
+                rejected.append((row, _("Invoice already in the register")))
+            elif self.partner_id and move['partner_id'] and move['partner_id'][0] != self.partner_id.id:
+                rejected.append((row, _("Invoice of another partner")))
+            else:
+                imported_move_ids.add(move['id'])
+                line_vals_list.append({
+                    'account_payment_register_id': self.id,
+                    'move_id': move['id'],
+                    'amount_payment': amount,
+                    'amount_balance': move['amount_residual'] - amount,
+                    'discount': row['discount'],
+                })
+        self.env['account.payment.register.line'].create(line_vals_list)
+        return len(line_vals_list), rejected
+
+    def action_import_remittance(self):
+        '''Add the invoices of the remittance file to the lines. The file is
+        streamed and processed by chunks; the rows which can't be matched
+        with an open invoice are not imported and are reported in the
+        chatter instead of aborting the whole import.
+
+        '''
+        self.ensure_one()
+        if self.state != 'draft':
+            raise UserError(_("You can only import a remittance in a draft register."))
+        if not self.import_file:
+            raise UserError(_("Please select the remittance file to import."))
+        imported_move_ids = set(self.register_line_ids.move_id.ids)
+        created_count = 0
+        rejected = []
+        for rows in split_every(REMITTANCE_IMPORT_CHUNK_SIZE, self._read_remittance_rows(), list):
+            count, chunk_rejected = self._import_remittance_chunk(rows, imported_move_ids)
+            created_count += count
+            rejected += chunk_rejected
+            # Release the records of the chunk from the cache.
+            self.env['account.payment.register.line'].flush()
+            self.env['account.payment.register.line'].invalidate_cache()
+        filename = self.import_filename or _('Remittance')
+        self.write({'import_file': False, 'import_filename': False})
+        body = _("%(file)s: %(created)s invoices imported, %(rejected)s rows rejected.") % {
+            'file': filename, 'created': created_count, 'rejected': len(rejected)}
+        attachments = []
+        if rejected:
+            report = io.StringIO()
+            writer = csv.writer(report)
+            writer.writerow(['row', 'reference', 'amount', 'error'])
+            for row, error in rejected:
+                writer.writerow([row['row'], row['reference'], row['amount'], error])
+            attachments.append(('%s_rejected.csv' % filename, report.getvalue().encode()))
+        self.message_post(body=body, attachments=attachments)
+        return True
+
+    def _prepare_discount_credit_note_vals(self, invoice, amount, rate=1.0):
+        '''Prepare the values of the credit note giving the discount of a
+        line: a draft credit note with only one "Discount by Client Payment"
+        line without taxes and the receivable/payable counterpart, built
+        directly with the right amounts instead of copying all the invoice
+        lines.
+
+        :param invoice: The account.move to give the discount.
+        :param amount: The discount amount, in the invoice currency.
+        :param rate: The rate from the invoice currency to the company
+            currency at the credit note date.
+        :return: The account.move values as a dictionary.
+
+        '''
+        date = fields.Date.context_today(self)
+        # Positive amount for the discount line of a customer credit note.
+        amount_currency = amount if invoice.move_type == 'out_invoice' else -amount
+        balance = invoice.company_id.currency_id.round(amount_currency * rate)
+        product_line = invoice.invoice_line_ids.filtered(
+            lambda l: l.product_id)[:1] or invoice.invoice_line_ids[:1]
+        term_line = invoice.line_ids.filtered(
+            lambda l: l.account_internal_type in ('receivable', 'payable'))[:1]
+        line_vals = {
+            'quantity': 1,
+            'currency_id': invoice.currency_id.id,
+            'partner_id': term_line.partner_id.id,
+        }
+        return {
+            'move_type': 'out_refund' if invoice.move_type == 'out_invoice' else 'in_refund',
+            'ref': _('Reversal of: %s', invoice.name),
+            'date': date,
+            'invoice_date': date,
+            'invoice_date_due': date,
+            'journal_id': invoice.journal_id.id,
+            'partner_id': invoice.partner_id.id,
+            'currency_id': invoice.currency_id.id,
+            'invoice_origin': invoice.invoice_origin,
+            'invoice_user_id': invoice.invoice_user_id.id,
+            'fiscal_position_id': invoice.fiscal_position_id.id,
+            'reversed_entry_id': invoice.id,
+            'line_ids': [
+                (0, 0, dict(line_vals,
+                            name='Discount by Client Payment',
+                            account_id=product_line.account_id.id,
+                            analytic_account_id=product_line.analytic_account_id.id,
+                            amount_currency=amount_currency,
+                            debit=balance > 0.0 and balance or 0.0,
+                            credit=balance < 0.0 and -balance or 0.0,
+                            tax_ids=[(6, 0, [])])),
+                (0, 0, dict(line_vals,
+                            name=term_line.name or '',
+                            account_id=term_line.account_id.id,
+                            date_maturity=date,
+                            exclude_from_invoice_tab=True,
+                            amount_currency=-amount_currency,
+                            debit=balance < 0.0 and -balance or 0.0,
+                            credit=balance > 0.0 and balance or 0.0)),
+            ],
+        }
+
+    @perf_span('create_discount_credit_notes')
+    def create_discount_credit_notes(self, lines, rates=None):
+        '''Create the credit notes of all the discount lines with one
+        account.move create.
+
+        :param lines: The account.payment.register.line with discount.
+        :param rates: The rates by (currency id, date) already looked up, see
+            _get_currency_rates().
+        :return: The created credit notes.
+
+        '''
+        date = fields.Date.context_today(self)
+        rates = dict(rates or {})
+        missing = [(line.currency_id, date) for line in lines
+                   if (line.currency_id.id, date) not in rates]
+        rates.update(self._get_currency_rates(missing))
+        vals_list = [
+            self._prepare_discount_credit_note_vals(
+                line.move_id, line.amount_balance, rates[line.currency_id.id, date])
+            for line in lines]
+        return self.env['account.move'].create(vals_list)
 
 
 class AccountPaymentRegisterLine(models.Model):
@@ -511,24 +1027,26 @@ class AccountPaymentRegisterLine(models.Model):
     register_id = fields.Many2one('account.custom.payment.register')
                                   
     account_payment_register_id = fields.Many2one('account.custom.payment.register',
-                                                  string='Register ID')
+                                                  string='Register ID', ondelete='cascade')
     move_id = fields.Many2one('account.move', string='Invoice/Bill',
-                              required=True)
+                              required=True, index=True)
     company_currency_id = fields.Many2one(
         related='account_payment_register_id.company_currency_id',
         string='Company Currency',
         readonly=True, store=True,
         help='Utility field to express amount currency')
+    currency_id = fields.Many2one(related='move_id.currency_id', store=True,
+                                  string='Currency')
     amount_total = fields.Monetary(string='Amount Total',
-                                   compute='_compute_amount_total_residual',
-                                   currency_field='company_currency_id')
+                                   related='move_id.amount_total', store=True,
+                                   currency_field='currency_id')
     amount_residual = fields.Monetary(string='Amount Due',
-                                      compute='_compute_amount_total_residual',
-                                      currency_field='company_currency_id')
+                                      related='move_id.amount_residual', store=True,
+                                      currency_field='currency_id')
     amount_payment = fields.Monetary(string='Payment Amount',
-                                     currency_field='company_currency_id')
+                                     currency_field='currency_id')
     amount_balance = fields.Monetary(string='Balance Amount',
-                                     currency_field='company_currency_id')
+                                     currency_field='currency_id')
     percent_balance = fields.Float(string='Balance Percent',
                                    compute="_compute_percent_balance",
                                    store=True)
@@ -538,17 +1056,13 @@ class AccountPaymentRegisterLine(models.Model):
     # is_authorized = fields.Boolean(default=False)
     
     credited_balance = fields.Float()
+    processed = fields.Boolean(readonly=True, copy=False,
+                               help="The payment of the line has been created.")
 
-    @api.depends('move_id')
-    def _compute_amount_total_residual(self):
-        for record in self:
-            if record.move_id:
-                record.write({
-                    'amount_total': record.move_id.amount_total,
-                    'amount_residual': record.move_id.amount_residual
-                })
-            else:
-                record.write({'amount_total': 0.0, 'amount_residual': 0.0})
+    _sql_constraints = [
+        ('register_move_uniq', 'unique(account_payment_register_id, move_id)',
+         "You can't select an invoice/bill multiple times!"),
+    ]
 
     @api.depends('amount_balance', 'amount_total')
     def _compute_percent_balance(self):
@@ -565,12 +1079,25 @@ class AccountPaymentRegisterLine(models.Model):
             if record.account_payment_register_id.partner_id and record.move_id:
                 if record.partner_id != record.account_payment_register_id.partner_id:
                     raise UserError(_("You can't select invoices/bills with different partners!"))
-            selected_move_ids = []
-            for each_record in self.account_payment_register_id.register_line_ids:
-                if each_record.move_id.id in selected_move_ids:
+            selected_move_ids = set()
+            for each_record in record.account_payment_register_id.register_line_ids:
+                move_id = each_record.move_id.id
+                if move_id in selected_move_ids:
                     raise UserError(_("You can't select an invoice/bill multiple times!"))
-                else:
-                    selected_move_ids.append(each_record.move_id.id)
+                if move_id:
+                    selected_move_ids.add(move_id)
+
+    @api.constrains('move_id', 'account_payment_register_id')
+    def _check_move_partner(self):
+        '''Same partner check than _onchange_move_id, done for all the lines
+        at once so it also applies on import and on RPC create.'''
+        partners_by_register = defaultdict(set)
+        for line in self:
+            partners_by_register[line.account_payment_register_id].add(
+                line.move_id.partner_id)
+        for register, partners in partners_by_register.items():
+            if register.partner_id and partners - {register.partner_id}:
+                raise ValidationError(_("You can't select invoices/bills with different partners!"))
 
     @api.onchange('amount_residual', 'amount_payment')
     def onchange_amount_balance(self):
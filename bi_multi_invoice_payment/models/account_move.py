@@ -10,6 +10,8 @@
 
 import logging
 
+from psycopg2 import OperationalError, errorcodes
+
 from odoo import _, api, fields, models
 from odoo.exceptions import UserError
 from odoo.tools import float_is_zero
@@ -21,9 +23,13 @@ _logger = logging.getLogger(__name__)
 class AccountMove(models.Model):
     _inherit = 'account.move'
 
-    # This field store the amount defined by the user in the draft payment.
+    # Deprecated: the amount defined by the user in the draft payment is now
+    # stored in account.payment.allocation. Kept for the data migration.
     prepayment_amount = fields.Float(default=0)
     related_payment_id = fields.Many2one('account.payment', copy=False)
+    payment_allocation_ids = fields.One2many(
+        'account.payment.allocation', 'move_id', string='Payment Allocations',
+        copy=False)
     # not_update_totals = fields.Boolean()
     set_complete_paid = fields.Boolean()
 
@@ -52,6 +58,60 @@ class AccountMove(models.Model):
             'type': 'ir.actions.act_window',
         }
 
+    def _post(self, soft=True):
+        posted = super(AccountMove, self)._post(soft=soft)
+        self.env['account.move.open.item']._refresh_open_items(posted.ids)
+        return posted
+
+    def button_draft(self):
+        res = super(AccountMove, self).button_draft()
+        self.env['account.move.open.item']._refresh_open_items(self.ids)
+        return res
+
+    def button_cancel(self):
+        res = super(AccountMove, self).button_cancel()
+        self.env['account.move.open.item']._refresh_open_items(self.ids)
+        return res
+
+    def _lock_for_payment(self, lines=None):
+        '''Lock the invoices/bills with their receivable/payable journal items
+        before paying or reconciling them. The rows are always locked in the
+        same order, first the moves then the journal items, each by id, so two
+        transactions paying overlapping invoices wait for each other instead
+        of deadlocking. NOWAIT makes the second one fail at once with a clear
+        error instead of waiting for the other to finish. The rows changed by
+        another transaction committed since this one started can't be locked
+        under REPEATABLE READ either, they give the same error.
+
+        :param lines: Other account.move.line to lock, with their moves.
+        '''
+        lines = lines or self.env['account.move.line']
+        moves = self | lines.move_id
+        if not moves:
+            return
+        cr = self.env.cr
+        try:
+            with cr.savepoint():
+                cr.execute("""
+                    SELECT id FROM account_move
+                     WHERE id IN %s
+                     ORDER BY id
+                       FOR UPDATE NOWAIT
+                """, [tuple(moves.ids)])
+                cr.execute("""
+                    SELECT id FROM account_move_line
+                     WHERE id IN %s
+                        OR (move_id IN %s
+                            AND account_internal_type IN ('receivable', 'payable'))
+                     ORDER BY id
+                       FOR UPDATE NOWAIT
+                """, [tuple(lines.ids) or (0,), tuple(self.ids) or (0,)])
+        except OperationalError as e:
+            if e.pgcode not in (errorcodes.LOCK_NOT_AVAILABLE, errorcodes.SERIALIZATION_FAILURE):
+                raise
+            raise UserError(_("Some of the invoices/bills are being paid by "
+                              "another user. Please try again in a moment."))
+
 
 class AccountMoveLine(models.Model):
     _inherit = 'account.move.line'
@@ -62,42 +122,66 @@ class AccountMoveLine(models.Model):
         """ This function loops on the 2 recordsets given as parameter as long as it
             can find a debit and a credit to reconcile together. It returns the recordset of the
             account move lines that were not reconciled during the process.
+
+            The lines are paired in one pass using index pointers on plain lists: the amount to
+            reconcile is the one specified in the wizard, so the residual amounts are not needed
+            to pair the lines and they are recomputed by the ORM once the partials are created.
         """
-        (debit_moves + credit_moves).read([field])
-        to_create = []
-        cash_basis = debit_moves and debit_moves[0].account_id.internal_type in ('receivable', 'payable') or False
+        (debit_moves + credit_moves).read([field, 'move_id', 'currency_id', 'date', 'company_id'])
+        debit_lines = list(debit_moves)
+        credit_lines = list(credit_moves)
+        cash_basis = debit_lines and debit_lines[0].account_id.internal_type in ('receivable', 'payable') or False
         cash_basis_percentage_before_rec = {}
-        dc_vals ={}
-        while (debit_moves and credit_moves):
-            debit_move = debit_moves[0]
-            credit_move = credit_moves[0]
+
+        # Pair the lines. If it is customer invoice only the debit pointer moves: the same
+        # payment line is reconciled with every invoice, each one for its own amount. Otherwise
+        # only the credit pointer moves.
+        pairs = []
+        debit_index = credit_index = 0
+        while debit_index < len(debit_lines) and credit_index < len(credit_lines):
+            pairs.append((debit_lines[debit_index], credit_lines[credit_index]))
+            if customer_payment:
+                debit_index += 1
+            else:
+                credit_index += 1
+
+        # Matched percentages of every involved move before the reconciliation,
+        # computed at once instead of once by pair.
+        if cash_basis and pairs:
+            paired_lines = debit_moves[:max(debit_index, 1)] + credit_moves[:max(credit_index, 1)]
+            paired_lines.move_id.line_ids.read(['account_id', 'balance', 'amount_currency',
+                                                'matched_debit_ids', 'matched_credit_ids'])
+            cash_basis_percentage_before_rec.update(paired_lines._get_matched_percentage())
+
+        # Rates looked up once by (from currency, to currency, date).
+        rates = {}
+
+        def get_rate(from_currency, to_currency, company, date):
+            key = (from_currency.id, to_currency.id, date)
+            if key not in rates:
+                rates[key] = self.env['res.currency']._get_conversion_rate(
+                    from_currency, to_currency, company, date)
+            return rates[key]
+
+        to_create = []
+        dc_vals = {}
+        for debit_move, credit_move in pairs:
             company_currency = debit_move.company_id.currency_id
-            temp_amount_residual_currency = 0
-            dc_vals[(debit_move.id, credit_move.id)] = (debit_move, credit_move, temp_amount_residual_currency)
             # Take the amount specified in wizard as reconciliation amount
             # If it is customer invoice, take from debit, else take from credit
             if customer_payment:
                 amount_reconcile = payment_amounts[debit_move.move_id.id]
             else:
                 amount_reconcile = payment_amounts[credit_move.move_id.id]
-            # Remove from recordset the one(s) that will be reconciled
-            # For optimization purpose, the creation of the partial_reconcile are done at the end,
-            # therefore during the process of reconciling several move lines, there are actually no recompute performed by the orm
-            # and thus the amount_residual are not recomputed, hence we have to do it manually.
-
-            debit_moves[0].amount_residual -= amount_reconcile
-            debit_moves[0].amount_residual_currency -= temp_amount_residual_currency
-            # Remove the move manually if it is customer invoice
-            # This is because we may need to register partial payment
-            if customer_payment:
-                debit_moves -= debit_move
-
-            credit_moves[0].amount_residual += amount_reconcile
-            credit_moves[0].amount_residual_currency += temp_amount_residual_currency
-            # Remove the move manually if it is not customer invoice
-            # This is because we may need to register partial payment
-            if not customer_payment:
-                credit_moves -= credit_move
+            temp_amount_residual_currency = 0
+            if field == 'amount_residual_currency':
+                # The wizard amount is in the currency of the lines, the
+                # partial amount in the company currency.
+                temp_amount_residual_currency = amount_reconcile
+                amount_reconcile = company_currency.round(amount_reconcile * get_rate(
+                    credit_move.currency_id, company_currency, debit_move.company_id,
+                    max(debit_move.date, credit_move.date)))
+            dc_vals[(debit_move.id, credit_move.id)] = (debit_move, credit_move, temp_amount_residual_currency)
 
             # Check for the currency and amount_currency we can set
             currency = False
@@ -105,20 +189,16 @@ class AccountMoveLine(models.Model):
             if field == 'amount_residual_currency':
                 currency = credit_move.currency_id.id
                 amount_reconcile_currency = temp_amount_residual_currency
-                amount_reconcile = amount_reconcile
             elif bool(debit_move.currency_id) != bool(credit_move.currency_id):
                 # If only one of debit_move or credit_move has a secondary currency, also record the converted amount
                 # in that secondary currency in the partial reconciliation. That allows the exchange difference entry
                 # to be created, in case it is needed. It also allows to compute the amount residual in foreign currency.
                 currency = debit_move.currency_id or credit_move.currency_id
                 currency_date = debit_move.currency_id and credit_move.date or debit_move.date
-                amount_reconcile_currency = company_currency._convert(amount_reconcile, currency, debit_move.company_id, currency_date)
+                amount_reconcile_currency = currency.round(amount_reconcile * get_rate(
+                    company_currency, currency, debit_move.company_id, currency_date))
                 currency = currency.id
 
-            if cash_basis:
-                tmp_set = debit_move | credit_move
-                cash_basis_percentage_before_rec.update(tmp_set._get_matched_percentage())
-
             to_create.append({
                 'debit_move_id': debit_move.id,
                 'credit_move_id': credit_move.id,
@@ -128,6 +208,7 @@ class AccountMoveLine(models.Model):
             })
 
         cash_basis_subjected = []
+        not_cash_basis_subjected = []
         part_rec = self.env['account.partial.reconcile']
         for partial_rec_dict in to_create:
             debit_move, credit_move, amount_residual_currency = dc_vals[partial_rec_dict['debit_move_id'], partial_rec_dict['credit_move_id']]
@@ -135,20 +216,188 @@ class AccountMoveLine(models.Model):
             # i. e: we don't really receive/give money in a customer/provider fashion
             # Since those are not subjected to cash basis computation we process them first
             if not amount_residual_currency and debit_move.currency_id and credit_move.currency_id:
-                part_rec.create(partial_rec_dict)
+                not_cash_basis_subjected.append(partial_rec_dict)
             else:
                 cash_basis_subjected.append(partial_rec_dict)
+        part_rec.create(not_cash_basis_subjected)
+
+        if not cash_basis:
+            part_rec.create(cash_basis_subjected)
+        else:
+            for new_recs in self._create_cash_basis_partial_batches(cash_basis_subjected, dc_vals):
+                for new_rec in new_recs:
+                    # if the pair belongs to move being reverted, do not create CABA entry
+                    if not (
+                            new_rec.debit_move_id.move_id == new_rec.credit_move_id.move_id.reversed_entry_id
+                            or
+                            new_rec.credit_move_id.move_id == new_rec.debit_move_id.move_id.reversed_entry_id
+                    ):
+                        new_rec.create_tax_cash_basis_entry(cash_basis_percentage_before_rec)
+        return debit_moves[debit_index:] + credit_moves[credit_index:]
+
+    def _create_cash_basis_partial_batches(self, vals_list, dc_vals):
+        """ Create the partials subjected to cash basis by batches and yield each created batch.
+            A cash basis entry uses the matched percentage of its moves right after its partial,
+            so two partials touching the same move having taxes on payment must not be in the
+            same batch. The moves without such taxes (like the payments) don't get cash basis
+            entries and are shared freely, so the usual customer payment, one payment line
+            reconciled with many invoices, is created in one batch. The order of the partials
+            touching a same move is kept.
+        """
+        involved_moves = self.env['account.move'].concat(*[
+            debit_move.move_id | credit_move.move_id for debit_move, credit_move, dummy in dc_vals.values()])
+        caba_move_ids = set(involved_moves.filtered(
+            lambda move: any(not line.tax_exigible for line in move.line_ids)).ids)
+        pending = vals_list
+        while pending:
+            batch, deferred, blocked_move_ids = [], [], set()
+            for vals in pending:
+                debit_move, credit_move, dummy = dc_vals[vals['debit_move_id'], vals['credit_move_id']]
+                move_ids = {debit_move.move_id.id, credit_move.move_id.id} & caba_move_ids
+                if move_ids & blocked_move_ids:
+                    deferred.append(vals)
+                else:
+                    batch.append(vals)
+                blocked_move_ids |= move_ids
+            yield self.env['account.partial.reconcile'].create(batch)
+            pending = deferred
+
+    def _get_reconciliation_network(self):
+        '''Collect all the journal items and partials linked to self through
+        the existing reconciliations.
+
+        :return: A tuple (account.move.line, account.partial.reconcile).
+        '''
+        involved_lines = self
+        involved_partials = self.env['account.partial.reconcile']
+        current_lines = involved_lines
+        while current_lines:
+            current_partials = (current_lines.matched_debit_ids
+                                + current_lines.matched_credit_ids) - involved_partials
+            involved_partials += current_partials
+            current_lines = (current_partials.debit_move_id
+                             + current_partials.credit_move_id) - involved_lines
+            involved_lines += current_lines
+        return involved_lines, involved_partials
+
+    def _check_grouped_reconcile_validity(self):
+        '''Same checks as the ones made by reconcile() on its records.'''
+        company = account = None
+        for line in self:
+            if line.reconciled:
+                raise UserError(_("You are trying to reconcile some entries that are already reconciled."))
+            if not line.account_id.reconcile and line.account_id.internal_type != 'liquidity':
+                raise UserError(_("Account %s does not allow reconciliation. First change the configuration of this account to allow it.")
+                                % line.account_id.display_name)
+            if line.move_id.state != 'posted':
+                raise UserError(_('You can only reconcile posted entries.'))
+            if company is None:
+                company = line.company_id
+            elif line.company_id != company:
+                raise UserError(_("Entries doesn't belong to the same company: %s != %s")
+                                % (company.display_name, line.company_id.display_name))
+            if account is None:
+                account = line.account_id
+            elif line.account_id != account:
+                raise UserError(_("Entries are not from the same account: %s != %s")
+                                % (account.display_name, line.account_id.display_name))
+
+    def custom_reconcile_grouped(self, line_groups):
+        '''Reconcile several groups of journal items in one grouped pass.
+        Each group ends up reconciled like group.reconcile() would do, but the
+        partials of all the groups are created with a single create() so the
+        residual amounts and the payment states are recomputed once for the
+        whole batch instead of once per group.
+
+        :param line_groups: A list of account.move.line recordsets.
+        :return: The created account.partial.reconcile records.
+        '''
+        partials = self.env['account.partial.reconcile']
+        pending = [group for group in line_groups if group]
+        all_lines = self.env['account.move.line'].concat(*pending)
+        all_lines.move_id._lock_for_payment(all_lines)
+        while pending:
+            # A journal item can only take part in one group per pass, otherwise
+            # its residual amount would be consumed twice. The overlapping
+            # groups are kept for the next pass, like a sequential reconcile.
+            batch, deferred, used_ids = [], [], set()
+            for group in pending:
+                if used_ids.isdisjoint(group.ids):
+                    batch.append(group)
+                    used_ids.update(group.ids)
+                else:
+                    deferred.append(group)
+            partials += self._custom_reconcile_batch(batch)
+            pending = deferred
+        return partials
+
+    def _custom_reconcile_batch(self, line_groups):
+        '''Reconcile disjoint groups of journal items, see
+        custom_reconcile_grouped().'''
+        all_lines = self.env['account.move.line'].concat(*line_groups)
+        not_paid_invoices = all_lines.move_id.filtered(
+            lambda m: m.is_invoice(include_receipts=True) and m.payment_state not in ('paid', 'in_payment'))
+        partial_vals_list = []
+        caba_flags = []
+        for group in line_groups:
+            group._check_grouped_reconcile_validity()
+            sorted_lines = group.sorted(key=lambda l: (l.date_maturity or l.date, l.currency_id))
+            vals_list = sorted_lines._prepare_reconciliation_partials()
+            is_cash_basis_needed = group[0].account_id.user_type_id.type in ('receivable', 'payable')
+            partial_vals_list += vals_list
+            caba_flags += [is_cash_basis_needed] * len(vals_list)
+        partials = self.env['account.partial.reconcile'].create(partial_vals_list)
+
+        # ==== Create entries for cash basis taxes ====
+        if not self._context.get('move_reverse_cancel'):
+            caba_partials = partials.browse(
+                [partial.id for partial, caba in zip(partials, caba_flags) if caba])
+            if caba_partials:
+                caba_partials._create_tax_cash_basis_moves()
 
-        for after_rec_dict in cash_basis_subjected:
-            new_rec = part_rec.create(after_rec_dict)
-            # if the pair belongs to move being reverted, do not create CABA entry
-            if cash_basis and not (
-                    new_rec.debit_move_id.move_id == new_rec.credit_move_id.move_id.reversed_entry_id
-                    or
-                    new_rec.credit_move_id.move_id == new_rec.debit_move_id.move_id.reversed_entry_id
-            ):
-                new_rec.create_tax_cash_basis_entry(cash_basis_percentage_before_rec)
-        return debit_moves+credit_moves
+        # ==== Create the full reconciles ====
+        exchange_moves = self.env['account.move']
+        done_line_ids = set()
+        for group in line_groups:
+            if done_line_ids.intersection(group.ids):
+                continue
+            involved_lines, involved_partials = group._get_reconciliation_network()
+            done_line_ids.update(involved_lines.ids)
+            if involved_lines.full_reconcile_id:
+                continue
+            if involved_lines[0].currency_id and all(line.currency_id == involved_lines[0].currency_id for line in involved_lines):
+                is_full_needed = all(line.currency_id.is_zero(line.amount_residual_currency) for line in involved_lines)
+            else:
+                is_full_needed = all(line.company_currency_id.is_zero(line.amount_residual) for line in involved_lines)
+            if not is_full_needed:
+                continue
+            exchange_move = None
+            if not self._context.get('no_exchange_difference'):
+                exchange_move = involved_lines._create_exchange_difference_move()
+                if exchange_move:
+                    exchange_move_lines = exchange_move.line_ids.filtered(
+                        lambda line: line.account_id == group[0].account_id)
+                    involved_lines += exchange_move_lines
+                    exchange_diff_partials = exchange_move_lines.matched_debit_ids \
+                        + exchange_move_lines.matched_credit_ids
+                    involved_partials += exchange_diff_partials
+                    partials += exchange_diff_partials
+                    exchange_moves |= exchange_move
+            self.env['account.full.reconcile'].create({
+                'exchange_move_id': exchange_move and exchange_move.id,
+                'partial_reconcile_ids': [(6, 0, involved_partials.ids)],
+                'reconciled_line_ids': [(6, 0, involved_lines.ids)],
+            })
+
+        # Post the exchange difference entries of all the groups at once.
+        if exchange_moves:
+            exchange_moves._post(soft=False)
+
+        # Trigger action for paid invoices
+        not_paid_invoices.filtered(
+            lambda m: m.payment_state in ('paid', 'in_payment')
+        ).action_invoice_paid()
+        return partials
 
     def custom_auto_reconcile_lines(self, payment_amounts, customer_payment):
         # Create list of debit and list of credit move ordered by date-currency
@@ -175,6 +424,7 @@ class AccountMoveLine(models.Model):
         # Call custom_auto_reconcile_lines() instead of auto_reconcile_lines() method
         if not self:
             return
+        self.move_id._lock_for_payment(self)
 
         # List unpaid invoices
         not_paid_invoices = self.mapped('move_id').filtered(
@@ -207,3 +457,23 @@ class AccountMoveLine(models.Model):
             lambda m: m.invoice_payment_state in ('paid', 'in_payment')
         ).action_invoice_paid()
         return True
+
+
+class AccountPartialReconcile(models.Model):
+    _inherit = 'account.partial.reconcile'
+
+    def _get_reconciled_move_ids(self):
+        return (self.debit_move_id.move_id | self.credit_move_id.move_id).ids
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        partials = super(AccountPartialReconcile, self).create(vals_list)
+        self.env['account.move.open.item']._refresh_open_items(
+            partials._get_reconciled_move_ids())
+        return partials
+
+    def unlink(self):
+        move_ids = self._get_reconciled_move_ids()
+        res = super(AccountPartialReconcile, self).unlink()
+        self.env['account.move.open.item']._refresh_open_items(move_ids)
+        return res
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+from odoo import api, fields, models
+
+_logger = logging.getLogger(__name__)
+
+# Fields of account.move copied in the open items.
+OPEN_ITEM_MOVE_FIELDS = ['partner_id', 'company_id', 'move_type', 'state',
+                         'amount_total', 'amount_residual',
+                         'invoice_date_due', 'date']
+
+
+class AccountMoveOpenItem(models.Model):
+    '''Open (posted and not fully paid) invoices and bills by company and
+    partner. It is a copy of the account.move rows the payment register
+    loads, kept in sync when the invoices are posted, reset to draft,
+    cancelled or (un)reconciled, so the register reads the open invoices of a
+    partner with a range scan of one index instead of filtering account_move.
+
+    '''
+    _name = 'account.move.open.item'
+    _description = 'Open Invoice/Bill'
+    _order = 'invoice_date_due, date, id'
+
+    move_id = fields.Many2one('account.move', string='Invoice/Bill',
+                              required=True, readonly=True, ondelete='cascade')
+    partner_id = fields.Many2one('res.partner', string='Partner', readonly=True)
+    company_id = fields.Many2one('res.company', string='Company', readonly=True)
+    move_type = fields.Selection([
+        ('out_invoice', 'Customer Invoice'),
+        ('in_invoice', 'Vendor Bill'),
+    ], readonly=True)
+    amount_total = fields.Float(readonly=True)
+    amount_residual = fields.Float(readonly=True)
+    invoice_date_due = fields.Date(string='Due Date', readonly=True)
+    date = fields.Date(readonly=True)
+
+    _sql_constraints = [
+        ('move_uniq', 'unique(move_id)', "An invoice/bill can only be open once!"),
+    ]
+
+    def init(self):
+        '''Index the open items in the order the register reads them and fill
+        the table the first time.'''
+        cr = self.env.cr
+        cr.execute("""
+            CREATE INDEX IF NOT EXISTS account_move_open_item_partner_due_index
+                ON account_move_open_item (company_id, partner_id, move_type,
+                                           invoice_date_due, date, id)
+        """)
+        cr.execute("SELECT 1 FROM account_move_open_item LIMIT 1")
+        if not cr.fetchone():
+            _logger.info("Filling the open invoices/bills table.")
+            self._refresh_open_items()
+
+    @api.model
+    def _refresh_open_items(self, move_ids=None):
+        '''Replace the open items of the given moves by their current state,
+        with one DELETE and one INSERT ... SELECT.
+
+        :param move_ids: A list of account.move ids, all the moves if None.
+        '''
+        if move_ids is not None and not move_ids:
+            return
+        self.env['account.move'].flush(OPEN_ITEM_MOVE_FIELDS)
+        move_clause = 'AND move.id IN %(move_ids)s' if move_ids is not None else ''
+        params = {
+            'move_ids': tuple(move_ids or ()),
+            'uid': self.env.uid,
+        }
+        self.env.cr.execute("""
+            DELETE FROM account_move_open_item
+             WHERE %s
+        """ % ('move_id IN %(move_ids)s' if move_ids is not None else 'TRUE'), params)
+        self.env.cr.execute("""
+            INSERT INTO account_move_open_item
+                   (move_id, partner_id, company_id, move_type, amount_total,
+                    amount_residual, invoice_date_due, date,
+                    create_uid, create_date, write_uid, write_date)
+            SELECT move.id, move.partner_id, move.company_id, move.move_type,
+                   move.amount_total, move.amount_residual,
+                   move.invoice_date_due, move.date,
+                   %%(uid)s, NOW() AT TIME ZONE 'UTC',
+                   %%(uid)s, NOW() AT TIME ZONE 'UTC'
+              FROM account_move move
+             WHERE move.state = 'posted'
+               AND move.move_type IN ('out_invoice', 'in_invoice')
+               AND move.amount_residual > 0
+               %s
+        """ % move_clause, params)
+        self.invalidate_cache()
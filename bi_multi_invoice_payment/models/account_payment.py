@@ -3,7 +3,9 @@
 import logging
 from odoo import _, api, fields, models
 from odoo.exceptions import UserError, ValidationError
-from datetime import date
+from collections import defaultdict
+
+from .payment_register_perf import perf_span
 
 _logger = logging.getLogger(__name__)
 
@@ -13,10 +15,10 @@ class AccountPayment(models.Model):
 
     deposit_number = fields.Char()
     check_number = fields.Char()
-    '''This is a great lack in the odoo core fields a data structure for
-    store numbers. The way to join instances fail (6,0,0) so is necessary store
-    the related id in this char format.'''
-    related_inv_char = fields.Char()
+    # Invoices paid by this payment and the amount allocated to each one.
+    allocation_ids = fields.One2many('account.payment.allocation',
+                                     'payment_id', string='Allocations',
+                                     copy=False)
     dime_q = fields.Char()
     use_bi_multi_inv_payment_module = fields.Boolean()
     related_invoice_ids = fields.One2many('account.move', 'related_payment_id')
@@ -49,7 +51,7 @@ class AccountPayment(models.Model):
                 all_lines = move.line_ids
                 liquidity_lines, counterpart_lines, writeoff_lines = pay._seek_for_lines()
                 if len(liquidity_lines) != 1 or len(counterpart_lines) != 1:
-                    if pay.related_inv_char:
+                    if pay.allocation_ids:
                         pass
                     else:
                         raise UserError(_(
@@ -131,9 +133,16 @@ class AccountPayment(models.Model):
             counterpart_amount = 0.0
             write_off_amount = 0.0
 
-        balance = self.currency_id._convert(counterpart_amount, self.company_id.currency_id, self.company_id, self.date)
+        # The register gives the rates it already looked up.
+        company_currency = self.company_id.currency_id
+        rate = (self._context.get('payment_register_rates') or {}).get(
+            (self.currency_id.id, self.date))
+        if rate is None:
+            rate = self.env['res.currency']._get_conversion_rate(
+                self.currency_id, company_currency, self.company_id, self.date)
+        balance = company_currency.round(counterpart_amount * rate)
         counterpart_amount_currency = counterpart_amount
-        write_off_balance = self.currency_id._convert(write_off_amount, self.company_id.currency_id, self.company_id, self.date)
+        write_off_balance = company_currency.round(write_off_amount * rate)
         write_off_amount_currency = write_off_amount
         currency_id = self.currency_id.id
 
@@ -171,18 +180,23 @@ class AccountPayment(models.Model):
                 'account_id': self.journal_id.payment_debit_account_id.id if balance < 0.0 else self.journal_id.payment_credit_account_id.id
             }
         ]
-        AccountMove = self.env['account.move']
-        for invoice_id in eval(self.related_inv_char):
-            invoice = AccountMove.search([('id', '=', invoice_id)])
+        allocated_amount = allocated_balance = 0.0
+        for allocation in self.allocation_ids:
+            # Convert the running total, so the rounded balances of the
+            # allocations always sum up to the balance of the payment.
+            allocated_amount += allocation.amount
+            allocation_balance = company_currency.round(
+                company_currency.round(allocated_amount * rate) - allocated_balance)
+            allocated_balance += allocation_balance
             # Receivable / Payable.
             line_vals_list.append(
                 {'name': self.payment_reference or default_line_name,
-                 'invoice_origin_id': invoice_id,
+                 'invoice_origin_id': allocation.move_id.id,
                  'date_maturity': self.date,
-                 'amount_currency': (invoice.prepayment_amount * -1),
+                 'amount_currency': (allocation.amount * -1),
                  'currency_id': currency_id,
-                 'debit': 0,
-                 'credit': invoice.prepayment_amount,
+                 'debit': allocation_balance < 0.0 and -allocation_balance or 0.0,
+                 'credit': allocation_balance > 0.0 and allocation_balance or 0.0,
                  'partner_id': self.partner_id.id,
                  'account_id': self.destination_account_id.id
                 }
@@ -200,79 +214,45 @@ class AccountPayment(models.Model):
             })
         return line_vals_list
 
+    @perf_span('action_post')
     def action_post(self):
         '''Redefined for create a Batch Payment for the related payments.
         Using the field Deposit Number for group the payments and by each
         group create a batch payment.
 
         '''
-        if not self.use_bi_multi_inv_payment_module:
-            return super(AccountPayment, self).action_post()
-        for payment in self:
-            # TODO: Find why this fields have the related invoices and also
-            # have the new credit notes and remove this unnecessary filter.
-            only_related_invoices = payment.related_invoice_ids.filtered(
+        multi_inv_payments = self.filtered('use_bi_multi_inv_payment_module')
+        res = True
+        if self - multi_inv_payments:
+            res = super(AccountPayment, self - multi_inv_payments).action_post()
+        if not multi_inv_payments:
+            return res
+        for payment in multi_inv_payments:
+            # Only the invoices, not the credit notes created for the
+            # discount lines.
+            only_related_invoices = payment.allocation_ids.move_id.filtered(
                 lambda x:x.type_name == 'Invoice')
             payment.reconciled_invoice_ids = only_related_invoices
-        default_meth = self.custom_post()
-        self.create_batch_deposit()
-        return default_meth
+        multi_inv_payments.custom_post()
+        multi_inv_payments.create_batch_deposit()
+        return res
 
+    @perf_span('create_batch_deposit')
     def create_batch_deposit(self):
-        '''Find if exist any other account.batch.payment with the given deposit
-        number and in this case add this new payment. If don't exist create a
-        new one.
+        '''Add the payments to the draft account.batch.payment of their
+        journal having the deposit number like reference, creating it when it
+        doesn't exist. The payments are grouped by journal and deposit number
+        and each group is attached with one write.
 
         '''
-        def find_old_batch_payment(deposit_number):
-            '''Find/return if exist an account batch deposit with the given
-            deposit number.
-
-            '''
-            return self.env['account.batch.payment'].search([
-                ('name', '=', deposit_number),('state', '=', 'draft')], limit=1)
-
-        old_batch = find_old_batch_payment(self.deposit_number)
-        if old_batch:
-            self.batch_payment_id = old_batch.id
-        else:
-            '''
-            By some odoo core validation is not possible create a batch
-            payment with this module bi_multi_invoice_payment. So is necessary
-            insert directly in the database a new batch deposit and stablish
-            a reationship with the payment if no exist a batch deposit with
-            the reference like de payment. If already exist a batch deposit
-            with the payment deposit number like reference, the current payment
-            is add to this old batch deposit.
-            TODO: REMOVE  THIS SQL
-
-            '''
-            insert_batch_payment_query = '''
-                INSERT INTO account_batch_payment(
-                    batch_type,
-                    date,
-                    state,
-                    export_filename,
-                    journal_id,
-                    payment_method_id,
-                    name)
-                VALUES('inbound',
-                       '{date}',
-                       'draft',
-                       '{export_filename}',
-                       '{journal_id}',
-                       '{payment_method_id}',
-                       '{name}');'''
-            self.env.cr.execute(insert_batch_payment_query.format(
-                date=str(date.today()),
-                export_filename=False,
-                journal_id=self.journal_id.id,
-                payment_method_id=self.payment_method_id.id,
-                name=self.deposit_number))
-            batch = self.env['account.batch.payment'].search([
-                ('name', '=', self.deposit_number),
-                ('state', '=', 'draft')], limit=1)
-            self.batch_payment_id = batch.id
+        BatchPayment = self.env['account.batch.payment']
+        payments_by_deposit = defaultdict(lambda: self.env['account.payment'])
+        for payment in self:
+            payments_by_deposit[(payment.journal_id, payment.deposit_number)] |= payment
+        for (journal, deposit_number), payments in payments_by_deposit.items():
+            batch = BatchPayment._get_or_create_draft_deposit(
+                journal, deposit_number, payments[0].payment_method_id)
+            payments.write({'batch_payment_id': batch.id})
         return True
 
     def action_custom_register_payment(self):
@@ -409,8 +389,8 @@ class AccountPayment(models.Model):
 
                 '''
                 result = []
-                # for invoice in self.invoice_ids:
-                for invoice in self.reconciled_invoice_ids:
+                for allocation in payment.allocation_ids:
+                    invoice = allocation.move_id
                     result.append(
                         (0, 0,
                          {'name': rec_pay_line_name,
@@ -419,7 +399,7 @@ class AccountPayment(models.Model):
                            # in really this is other account move
                           'invoice_origin_id': invoice.id,
                           'debit': 0,
-                          'credit': invoice.prepayment_amount,
+                          'credit': allocation.amount,
                           'date_maturity': payment.date,
                           'partner_id': payment.partner_id.commercial_partner_id.id,
                           'account_id': payment.destination_account_id.id,
@@ -508,6 +488,7 @@ class AccountPayment(models.Model):
                 all_move_vals.append(transfer_move_vals)
         return all_move_vals
 
+    @perf_span('custom_post')
     def custom_post(self):
         """ Create the journal items for the payment and update the payment's
         state to 'posted'.
@@ -523,59 +504,130 @@ class AccountPayment(models.Model):
             Call custom_reconcile() method instead of reconcile()
         """
         # payment_amounts = {}
-        # for move in self.invoice_ids:
-        #     payment_amounts[move.id] = move.prepayment_amount
-        if self.amount == 0:
-            self.amount = self.total_invoice_amount
-            # self.amount = self.env['account.payment']._compute_payment_amount(
-            #     self.invoice_ids, self.currency_id, self.journal_id,
-            #     self.payment_date)
-        # If amount is positive it is customer related else vendor related
-        if self.amount > 0:
-            customer_payment = True
-        elif self.amount < 0:
-            customer_payment = False
-        else:
+        # for allocation in self.allocation_ids:
+        #     payment_amounts[allocation.move_id.id] = allocation.amount
+        if any(not rec.amount for rec in self):
             raise UserError(_("Nothing to invoice!"))
-        # self.create_batch_deposit()
-        AccountMove = self.env['account.move'].with_context(default_type='entry')
-        for rec in self:        
-            # if rec.state != 'draft':
-            #     raise UserError(_("Only a draft payment can be posted."))
-            if any(inv.state != 'posted' for inv in rec.reconciled_invoice_ids):
-                raise ValidationError(_("The payment cannot be processed "+\
-                                        "because the invoice is not open!"))
-            # keep the name in case of a payment reset to draft
-            if not rec.name:
-                # Use the right sequence to set the name
-                if rec.payment_type == 'transfer':
-                    sequence_code = 'account.payment.transfer'
-                else:
-                    if rec.partner_type == 'customer':
-                        if rec.payment_type == 'inbound':
-                            sequence_code = 'account.payment.customer.invoice'
-                        if rec.payment_type == 'outbound':
-                            sequence_code = 'account.payment.customer.refund'
-                    if rec.partner_type == 'supplier':
-                        if rec.payment_type == 'inbound':
-                            sequence_code = 'account.payment.supplier.refund'
-                        if rec.payment_type == 'outbound':
-                            sequence_code = 'account.payment.supplier.invoice'
-                rec.name = self.env['ir.sequence'].next_by_code(
-                    sequence_code, sequence_date=rec.payment_date)
-                if not rec.name and rec.payment_type != 'transfer':
-                    raise UserError(_("You have to define a sequence for %s in your company.") % (sequence_code,))
-            rec.write({'state': 'posted'})
-            AccountMove = self.env['account.move']
-            for pay_move_line in rec.move_id.line_ids.filtered(
-                    lambda l: l.invoice_origin_id):
-                invoice = AccountMove.search([
-                    ('id', '=', pay_move_line.invoice_origin_id)])
-                line_funct = lambda x: (
-                    x.debit > 0 and x.account_id.id == pay_move_line.account_id.id)
-                line = invoice.line_ids.filtered(line_funct)
-                AccountMoveLine = self.env['account.move.line']
-                AccountMoveLine |= pay_move_line
-                AccountMoveLine |= line
-                AccountMoveLine.reconcile()
+        (self.allocation_ids.move_id | self.move_id)._lock_for_payment()
+        # if any(rec.state != 'draft' for rec in self):
+        #     raise UserError(_("Only a draft payment can be posted."))
+        if any(inv.state != 'posted' for inv in self.reconciled_invoice_ids):
+            raise ValidationError(_("The payment cannot be processed "+\
+                                    "because the invoice is not open!"))
+        # keep the name in case of a payment reset to draft
+        self.filtered(lambda r: not r.name)._assign_payment_names()
+        self.write({'state': 'posted'})
+        self._reconcile_invoice_origin_lines()
         return True
+
+    def _get_payment_sequence_code(self):
+        '''Return the ir.sequence code used to name the payment.'''
+        self.ensure_one()
+        if self.payment_type == 'transfer':
+            return 'account.payment.transfer'
+        return {
+            ('customer', 'inbound'): 'account.payment.customer.invoice',
+            ('customer', 'outbound'): 'account.payment.customer.refund',
+            ('supplier', 'inbound'): 'account.payment.supplier.refund',
+            ('supplier', 'outbound'): 'account.payment.supplier.invoice',
+        }.get((self.partner_type, self.payment_type))
+
+    def _assign_payment_names(self):
+        '''Set the name of the payments using the right sequence. The
+        sequence of each code is searched once for all the payments and the
+        numbers of all the payments using it are reserved at once (see
+        _reserve_sequence_names), instead of one ir.sequence._next() call by
+        payment.
+
+        '''
+        IrSequence = self.env['ir.sequence']
+        sequences = {}
+        payments_by_sequence = defaultdict(lambda: self.env['account.payment'])
+        for rec in self:
+            sequence_code = rec._get_payment_sequence_code()
+            if sequence_code not in sequences:
+                sequences[sequence_code] = IrSequence.search([
+                    ('code', '=', sequence_code),
+                    ('company_id', 'in', [self.env.company.id, False])],
+                    order='company_id', limit=1)
+            sequence = sequences[sequence_code]
+            if not sequence:
+                if rec.payment_type != 'transfer':
+                    raise UserError(_("You have to define a sequence for %s in your company.") % (sequence_code,))
+                continue
+            # The date only matters for the sequences by date range.
+            sequence_date = rec.date if sequence.use_date_range else False
+            payments_by_sequence[(sequence, sequence_date)] |= rec
+        for (sequence, sequence_date), payments in payments_by_sequence.items():
+            names = self._reserve_sequence_names(sequence, len(payments), sequence_date)
+            for payment, name in zip(payments, names):
+                payment.name = name
+
+    @api.model
+    def _reserve_sequence_names(self, sequence, count, sequence_date=False):
+        '''Reserve count numbers of the sequence with one query and return
+        their names, like count calls of sequence._next(sequence_date).
+
+        :param sequence: The ir.sequence.
+        :param count: The number of names to reserve.
+        :param sequence_date: The date choosing the date range of the
+            sequences using them.
+        :return: A list of names.
+        '''
+        number_holder = sequence
+        if sequence.use_date_range:
+            date = sequence_date or fields.Date.today()
+            number_holder = self.env['ir.sequence.date_range'].search([
+                ('sequence_id', '=', sequence.id),
+                ('date_from', '<=', date),
+                ('date_to', '>=', date)], limit=1)
+            if not number_holder:
+                number_holder = sequence._create_date_range_seq(date)
+            sequence = sequence.with_context(ir_sequence_date_range=number_holder.date_from)
+        cr = self.env.cr
+        if sequence.implementation == 'standard':
+            if sequence.use_date_range:
+                sequence_name = 'ir_sequence_%03d_%03d' % (sequence.id, number_holder.id)
+            else:
+                sequence_name = 'ir_sequence_%03d' % sequence.id
+            cr.execute("SELECT nextval(%s) FROM generate_series(1, %s)",
+                       [sequence_name, count])
+            numbers = [row[0] for row in cr.fetchall()]
+        else:
+            # No gap: move number_next once for all the reserved numbers.
+            increment = sequence.number_increment
+            number_holder.flush(['number_next'])
+            cr.execute("""
+                UPDATE %s SET number_next = number_next + %%s
+                 WHERE id = %%s
+             RETURNING number_next
+            """ % number_holder._table, [increment * count, number_holder.id])
+            number_end = cr.fetchone()[0]
+            number_holder.invalidate_cache(['number_next'], number_holder.ids)
+            numbers = range(number_end - increment * count, number_end, increment)
+        return [sequence.get_next_char(number) for number in numbers]
+
+    def _reconcile_invoice_origin_lines(self):
+        '''Reconcile each journal item of the payments having an
+        invoice_origin_id with the debit items of that invoice using the same
+        account. The origin invoice items of all the payments are fetched with
+        one query and all the pairs are reconciled in one grouped pass.
+
+        '''
+        AccountMoveLine = self.env['account.move.line']
+        pay_move_lines = self.move_id.line_ids.filtered(
+            lambda l: l.invoice_origin_id)
+        if not pay_move_lines:
+            return
+        invoice_lines = AccountMoveLine.search([
+            ('move_id', 'in', list(set(pay_move_lines.mapped('invoice_origin_id')))),
+            ('account_id', 'in', pay_move_lines.account_id.ids),
+            ('debit', '>', 0)])
+        lines_by_invoice = defaultdict(lambda: AccountMoveLine)
+        for line in invoice_lines:
+            lines_by_invoice[(line.move_id.id, line.account_id.id)] |= line
+        line_groups = [
+            pay_move_line | lines_by_invoice[(pay_move_line.invoice_origin_id,
+                                              pay_move_line.account_id.id)]
+            for pay_move_line in pay_move_lines]
+        AccountMoveLine.custom_reconcile_grouped(line_groups)
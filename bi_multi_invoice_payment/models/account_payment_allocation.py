@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+import logging
+from odoo import fields, models
+from odoo.tools import column_exists
+
+_logger = logging.getLogger(__name__)
+
+
+class AccountPaymentAllocation(models.Model):
+    '''Amount of a multi invoice payment allocated to each invoice/bill.
+    Replace the old account.payment.related_inv_char field who stored the
+    invoice ids as a python list in a char, and the account.move
+    prepayment_amount field who was shared by all the registers using the
+    same invoice. The posting only reads the amounts from here.
+
+    '''
+    _name = 'account.payment.allocation'
+    _description = 'Account Payment Allocation'
+    _order = 'payment_id, id'
+
+    payment_id = fields.Many2one('account.payment', string='Payment',
+                                 required=True, index=True, ondelete='cascade')
+    move_id = fields.Many2one('account.move', string='Invoice/Bill',
+                              required=True, index=True, ondelete='restrict')
+    register_id = fields.Many2one('account.custom.payment.register',
+                                  string='Payment Register', index=True,
+                                  ondelete='set null')
+    register_line_id = fields.Many2one('account.payment.register.line',
+                                       string='Payment Register Line',
+                                       ondelete='set null')
+    currency_id = fields.Many2one(related='payment_id.currency_id')
+    amount = fields.Monetary(string='Allocated Amount',
+                             currency_field='currency_id')
+
+    _sql_constraints = [
+        ('payment_move_uniq', 'unique(payment_id, move_id)',
+         'An invoice/bill can only be allocated once by payment.'),
+    ]
+
+    def init(self):
+        '''Migrate the payments still using the related_inv_char column.
+        The allocated amount is taken from the payment journal item created
+        for the invoice and, if there is none, from the prepayment_amount
+        stored in the invoice.
+
+        '''
+        if not column_exists(self.env.cr, 'account_payment', 'related_inv_char'):
+            return
+        self.env.cr.execute('''
+            WITH legacy AS (
+                SELECT pay.id AS payment_id,
+                       pay.move_id AS payment_move_id,
+                       btrim(unnest(string_to_array(
+                           btrim(pay.related_inv_char, '[] '), ','))) AS invoice_id
+                  FROM account_payment pay
+                 WHERE btrim(COALESCE(pay.related_inv_char, ''), '[] ') != ''
+                   AND NOT EXISTS (
+                       SELECT 1 FROM account_payment_allocation alloc
+                        WHERE alloc.payment_id = pay.id)
+            )
+            INSERT INTO account_payment_allocation (
+                payment_id, move_id, amount,
+                create_uid, create_date, write_uid, write_date)
+            SELECT DISTINCT ON (legacy.payment_id, inv.id)
+                   legacy.payment_id, inv.id,
+                   COALESCE((SELECT SUM(aml.credit - aml.debit)
+                               FROM account_move_line aml
+                              WHERE aml.move_id = legacy.payment_move_id
+                                AND aml.invoice_origin_id = inv.id),
+                            inv.prepayment_amount, 0.0),
+                   %s, now() at time zone 'UTC', %s, now() at time zone 'UTC'
+              FROM legacy
+              JOIN account_move inv ON inv.id::text = legacy.invoice_id
+        ''', (self.env.uid, self.env.uid))
+        if self.env.cr.rowcount:
+            _logger.info("Migrated %s payment allocations from related_inv_char.",
+                         self.env.cr.rowcount)
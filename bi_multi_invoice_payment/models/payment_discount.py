@@ -1,7 +1,7 @@
 # © 2021 onDevelop.sa
 # Autor: Idelis Gé Ramírez
 
-from odoo import api, fields, models, _
+from odoo import api, fields, models, tools, _
 from odoo.exceptions import UserError, ValidationError
 
     
@@ -12,3 +12,35 @@ class PaymentDiscount(models.Model):
 
     max_payment_discount = fields.Integer()
     pretty_discount = fields.Integer(related='max_payment_discount')
+    # Empty company means the policy apply to all the companies.
+    company_id = fields.Many2one('res.company', string='Company')
+
+    @api.model
+    @tools.ormcache('company_id')
+    def _get_max_payment_discount(self, company_id):
+        '''Return the max payment discount percent of the last policy defined
+        for the company, or of the last one for all the companies when the
+        company has none. The result is cached and the cache is cleared on any
+        change of the policies.
+
+        '''
+        # The company policies first: the empty company_id sorts last.
+        policy = self.sudo().search([('company_id', 'in', [company_id, False])],
+                                    limit=1, order='company_id, id desc')
+        return policy.max_payment_discount
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        res = super(PaymentDiscount, self).create(vals_list)
+        self.clear_caches()
+        return res
+
+    def write(self, vals):
+        res = super(PaymentDiscount, self).write(vals)
+        self.clear_caches()
+        return res
+
+    def unlink(self):
+        res = super(PaymentDiscount, self).unlink()
+        self.clear_caches()
+        return res
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from odoo import fields, models, tools
+
+_logger = logging.getLogger(__name__)
+
+
+def perf_span(name):
+    '''Decorate a method of the payment register pipeline to measure it in
+    a timing span, see PaymentRegisterPerf._span().'''
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.env['payment.register.perf']._span(name, self):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class PaymentRegisterPerf(models.Model):
+    _name = 'payment.register.perf'
+    _description = 'Payment Register Timing Span'
+    _order = 'id desc'
+
+    name = fields.Char(string='Stage', required=True, readonly=True)
+    res_model = fields.Char(string='Model', readonly=True)
+    res_ids = fields.Char(string='Record IDs', readonly=True)
+    record_count = fields.Integer(string='Records', readonly=True)
+    duration = fields.Float(string='Wall Time (ms)', digits=(16, 1), readonly=True)
+    query_count = fields.Integer(string='SQL Queries', readonly=True)
+    query_time = fields.Float(string='SQL Time (ms)', digits=(16, 1), readonly=True)
+    row_count = fields.Integer(string='Rows Touched', readonly=True)
+
+    def _is_span_logging_enabled(self):
+        '''Return if the spans are stored in this model, set by the
+        bi_multi_invoice_payment.perf_log system parameter. When disabled the
+        spans are only sent to the logger at debug level.
+
+        '''
+        return tools.str2bool(self.env['ir.config_parameter'].sudo().get_param(
+            'bi_multi_invoice_payment.perf_log', 'False'), False)
+
+    def _get_rows_touched(self):
+        '''Number of rows inserted, updated or deleted by the current
+        transaction so far.'''
+        self.env.cr.execute("""
+            SELECT COALESCE(SUM(n_tup_ins + n_tup_upd + n_tup_del), 0)
+              FROM pg_stat_xact_user_tables
+        """)
+        return self.env.cr.fetchone()[0]
+
+    @contextmanager
+    def _span(self, name, records):
+        '''Measure the wall time, the number and time of the SQL queries and
+        the rows touched by the code run in the context, and send them to the
+        logger. The rows touched are only measured, and the span stored in
+        this model, when the perf_log system parameter is enabled.
+
+        :param name: The name of the measured stage.
+        :param records: The recordset the stage is run on.
+        '''
+        cr = self.env.cr
+        thread = threading.current_thread()
+        enabled = self._is_span_logging_enabled()
+        if not enabled and not _logger.isEnabledFor(logging.DEBUG):
+            yield
+            return
+        rows_before = self._get_rows_touched() if enabled else 0
+        query_count_before = cr.sql_log_count
+        query_time_before = getattr(thread, 'query_time', 0.0)
+        start = time.time()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            values = {
+                'name': name,
+                'res_model': records._name,
+                'res_ids': ','.join(str(i) for i in records.ids[:50]),
+                'record_count': len(records),
+                'duration': (time.time() - start) * 1000,
+                'query_count': cr.sql_log_count - query_count_before,
+                'query_time': (getattr(thread, 'query_time', 0.0) - query_time_before) * 1000,
+            }
+            # The transaction is probably aborted after a failure.
+            if enabled and not failed:
+                values['row_count'] = self._get_rows_touched() - rows_before
+            _logger.log(
+                logging.INFO if enabled else logging.DEBUG,
+                "span=%(name)s model=%(res_model)s ids=%(res_ids)s records=%(record_count)s "
+                "wall_ms=%(duration).1f queries=%(query_count)s sql_ms=%(query_time).1f "
+                "rows=%(row_count)s failed=%(failed)s",
+                dict(values, row_count=values.get('row_count', ''), failed=failed))
+            if enabled and not failed:
+                self.sudo().create(values)
@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+
+from . import test_benchmark
+from . import test_reconcile_lines
+from . import test_concurrency
+from . import test_register_render
+from . import test_open_items
+from . import test_remittance_import
+from . import test_batch_deposit
+from . import test_payment_register
+from . import test_discount_credit_notes
+from . import test_foreign_currency
+from . import test_payment_job
+from . import test_payment_names
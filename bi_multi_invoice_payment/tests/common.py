@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+from odoo import fields
+from odoo.addons.account.tests.common import AccountTestInvoicingCommon
+
+
+class MultiInvoicePaymentCommon(AccountTestInvoicingCommon):
+
+    @classmethod
+    def setUpClass(cls, chart_template_ref=None):
+        super(MultiInvoicePaymentCommon, cls).setUpClass(chart_template_ref=chart_template_ref)
+        cls.bank_journal = cls.company_data['default_journal_bank']
+
+    @classmethod
+    def _create_invoices(cls, partner, count, amount=100.0, post=True, **values):
+        '''Create count customer invoices of the partner, with one line of
+        the given amount without taxes.'''
+        invoices = cls.env['account.move'].create([dict({
+            'move_type': 'out_invoice',
+            'partner_id': partner.id,
+            'invoice_date': fields.Date.from_string('2021-01-01'),
+            'invoice_line_ids': [(0, 0, {
+                'name': 'Line %s' % index,
+                'quantity': 1,
+                'price_unit': amount,
+                'account_id': cls.company_data['default_account_revenue'].id,
+                'tax_ids': [(6, 0, [])],
+            })],
+        }, **values) for index in range(count)])
+        if post:
+            invoices.action_post()
+        return invoices
+
+    @classmethod
+    def _create_register(cls, invoices, amount=None, **values):
+        '''Create a register paying the invoices, each one for the given
+        amount or for its whole residual.'''
+        line_commands = []
+        for invoice in invoices:
+            amount_payment = invoice.amount_residual if amount is None else amount
+            line_commands.append((0, 0, {
+                'move_id': invoice.id,
+                'amount_payment': amount_payment,
+                'amount_balance': invoice.amount_residual - amount_payment,
+            }))
+        return cls.env['account.custom.payment.register'].create(dict({
+            'partner_id': invoices[0].partner_id.id,
+            'journal_id': cls.bank_journal.id,
+            'deposit_number': 'DEPOSIT/TEST',
+            'check_number': 'CHECK/TEST',
+            'register_line_ids': line_commands,
+        }, **values))
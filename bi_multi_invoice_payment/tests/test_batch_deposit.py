@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+
+from psycopg2 import IntegrityError
+
+from odoo.tests import tagged
+from odoo.tools import mute_logger
+
+from .common import MultiInvoicePaymentCommon
+
+
+@tagged('post_install', '-at_install')
+class TestBatchDeposit(MultiInvoicePaymentCommon):
+
+    def test_get_or_create_draft_deposit(self):
+        BatchPayment = self.env['account.batch.payment']
+        payment_method = self.env.ref('account.account_payment_method_manual_in')
+        batch = BatchPayment._get_or_create_draft_deposit(
+            self.bank_journal, 'DEPOSIT/1', payment_method)
+        self.assertRecordValues(batch, [{
+            'name': 'DEPOSIT/1', 'journal_id': self.bank_journal.id, 'state': 'draft'}])
+        self.assertEqual(BatchPayment._get_or_create_draft_deposit(
+            self.bank_journal, 'DEPOSIT/1', payment_method), batch)
+        other_batch = BatchPayment._get_or_create_draft_deposit(
+            self.bank_journal, 'DEPOSIT/2', payment_method)
+        self.assertNotEqual(other_batch, batch)
+
+        # Two draft deposits can't share their number.
+        with self.assertRaises(IntegrityError), mute_logger('odoo.sql_db'), self.cr.savepoint():
+            other_batch.name = 'DEPOSIT/1'
+            other_batch.flush()
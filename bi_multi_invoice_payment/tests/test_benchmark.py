@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import tempfile
+import time
+from collections import defaultdict
+from unittest.mock import patch
+
+from odoo.tests import tagged
+
+from .common import MultiInvoicePaymentCommon
+
+_logger = logging.getLogger(__name__)
+
+# Number of open invoices of the partner, BI_MULTI_INVOICE_PAYMENT_BENCHMARK_SIZES
+# (comma separated) overrides them.
+BENCHMARK_SIZES = [10, 100, 1000, 10000]
+# Number of discounted invoices of the credit notes benchmark.
+DISCOUNT_BENCHMARK_SIZE = 500
+# Number of payments of the ungrouped registers posted by the benchmark.
+UNGROUPED_BENCHMARK_SIZES = [1, 1000]
+# Number of lines of the register whose payment values are prepared.
+PAYMENTS_VALS_BENCHMARK_SIZE = 5000
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'benchmark_baseline.json')
+# Allowed increase of the query count of a stage over the baseline.
+QUERY_COUNT_TOLERANCE = 0.1
+QUERY_COUNT_MARGIN = 5
+
+
+class FilteredLinesLookup(object):
+    '''Look the register lines up like get_payments_vals did before
+    _get_lines_by_move: the lines are filtered again for every invoice.'''
+
+    def __init__(self, lines):
+        self.lines = lines
+
+    def get(self, move_id, default):
+        return self.lines.filtered(lambda line: line.move_id.id == move_id) or default
+
+
+@tagged('-standard', 'post_install', '-at_install', 'bi_multi_invoice_payment_benchmark')
+class TestMultiInvoicePaymentBenchmark(MultiInvoicePaymentCommon):
+    '''Time and count the queries of each stage of the register flow for
+    partners with more and more open invoices, of the creation of the
+    discount credit notes of 500 invoices, of the posting of 1 and 1000
+    ungrouped payments and of the preparation of the payments of 5000
+    lines. The results are written as JSON
+    (BI_MULTI_INVOICE_PAYMENT_BENCHMARK_OUTPUT, a file in the temporary
+    directory by default) and the query counts are compared with
+    benchmark_baseline.json, a stage missing from the baseline fails. Running
+    with BI_MULTI_INVOICE_PAYMENT_BENCHMARK_UPDATE_BASELINE=1 records the
+    results as the new baseline instead.
+
+    The benchmark is not part of the standard tests, it is run with
+    --test-tags bi_multi_invoice_payment_benchmark.
+
+    '''
+
+    def _get_sizes(self):
+        sizes = os.environ.get('BI_MULTI_INVOICE_PAYMENT_BENCHMARK_SIZES')
+        if sizes:
+            return [int(size) for size in sizes.split(',')]
+        return BENCHMARK_SIZES
+
+    def _measure(self, stages, stage, function):
+        '''Run the function with an empty cache and record its wall time and
+        number of queries, pending writes included.'''
+        self.env['base'].flush()
+        self.env['base'].invalidate_cache()
+        query_count = self.cr.sql_log_count
+        start = time.time()
+        result = function()
+        self.env['base'].flush()
+        stages[stage] = {
+            'queries': self.cr.sql_log_count - query_count,
+            'seconds': round(time.time() - start, 4),
+        }
+        return result
+
+    def _run_stages(self, size):
+        stages = {}
+        partner = self.env['res.partner'].create({'name': 'Benchmark %s' % size})
+        invoices = self._create_invoices(partner, size)
+        Register = self.env['account.custom.payment.register']
+
+        self._measure(stages, 'default_get', lambda: Register.with_context(
+            active_model='account.move', active_ids=invoices.ids,
+        ).default_get(list(Register._fields)))
+
+        new_register = Register.new({
+            'partner_id': partner.id,
+            'journal_id': self.bank_journal.id,
+        })
+        self._measure(stages, '_onchange_partner_id', new_register._onchange_partner_id)
+
+        register = self._create_register(invoices, amount=0.0)
+        self._measure(stages, 'autofill_lines', register.autofill_lines)
+
+        action = self._measure(stages, 'create_payments', register.create_payments)
+        payments = self.env['account.payment'].search(action['domain'])
+
+        # The reconciliation is measured on its own.
+        with patch.object(type(payments), '_reconcile_invoice_origin_lines', lambda self: None):
+            self._measure(stages, 'action_post', payments.action_post)
+        self._measure(stages, 'custom_reconcile', payments._reconcile_invoice_origin_lines)
+        self.assertTrue(all(invoice.payment_state in ('paid', 'in_payment')
+                            for invoice in invoices))
+        return stages
+
+    def _run_discount_stages(self, size):
+        '''Create the discount credit notes of a register of size discounted
+        invoices.'''
+        stages = {}
+        partner = self.env['res.partner'].create({'name': 'Discount Benchmark %s' % size})
+        register = self._create_register(self._create_invoices(partner, size), amount=90.0)
+        lines = register.register_line_ids
+        lines.write({'discount': True})
+        self._measure(stages, 'create_discount_credit_notes',
+                      lambda: register.create_discount_credit_notes(lines))
+        return stages
+
+    def _run_ungrouped_stages(self, size):
+        '''Post the size payments of an ungrouped register, one by invoice.'''
+        stages = {}
+        partner = self.env['res.partner'].create({'name': 'Ungrouped Benchmark %s' % size})
+        register = self._create_register(self._create_invoices(partner, size), group_payment=False)
+        action = register.create_payments()
+        payments = self.env['account.payment'].search(action['domain'])
+        self._measure(stages, 'action_post', payments.action_post)
+        return stages
+
+    def _run_payments_vals_stages(self, size):
+        '''Prepare the payment values of a register of size lines, looking
+        the lines up by invoice (get_payments_vals) and, as before, filtering
+        them for every invoice (get_payments_vals_filtered).'''
+        stages = {}
+        partner = self.env['res.partner'].create({'name': 'Payment Values Benchmark %s' % size})
+        register = self._create_register(self._create_invoices(partner, size))
+        vals_list = self._measure(stages, 'get_payments_vals', register.get_payments_vals)
+
+        def get_payments_vals_filtered():
+            lookup = FilteredLinesLookup(register.register_line_ids)
+            invoices = register.invoice_ids or register.register_line_ids.move_id
+            groups = defaultdict(list)
+            for invoice in invoices:
+                key = register._get_payment_group_key(invoice) if register.group_payment else invoice.id
+                groups[key].append(invoice)
+            return [register._prepare_payment_vals(register.env['account.move'].concat(*group), lookup)
+                    for group in groups.values()]
+        filtered_vals_list = self._measure(stages, 'get_payments_vals_filtered',
+                                           get_payments_vals_filtered)
+        self.assertEqual(vals_list, filtered_vals_list)
+        return stages
+
+    def _compare_with_baseline(self, results, baseline):
+        for case, stages in results.items():
+            for stage, measure in stages.items():
+                expected = baseline.get(case, {}).get(stage)
+                self.assertTrue(
+                    expected,
+                    "No benchmark baseline for %s (%s), record it with "
+                    "BI_MULTI_INVOICE_PAYMENT_BENCHMARK_UPDATE_BASELINE=1." % (stage, case))
+                allowed = int(expected['queries'] * (1 + QUERY_COUNT_TOLERANCE)) + QUERY_COUNT_MARGIN
+                self.assertLessEqual(
+                    measure['queries'], allowed,
+                    "%s (%s): %s queries, %s in the baseline."
+                    % (stage, case, measure['queries'], expected['queries']))
+                if measure['seconds'] > 2 * expected['seconds']:
+                    _logger.warning("%s (%s): %.2fs, %.2fs in the baseline.",
+                                    stage, case, measure['seconds'], expected['seconds'])
+
+    def test_register_flow_benchmark(self):
+        results = {}
+        for size in self._get_sizes():
+            with self.subTest(size=size):
+                results[str(size)] = self._run_stages(size)
+        results['discount_%s' % DISCOUNT_BENCHMARK_SIZE] = self._run_discount_stages(
+            DISCOUNT_BENCHMARK_SIZE)
+        for size in UNGROUPED_BENCHMARK_SIZES:
+            results['ungrouped_%s' % size] = self._run_ungrouped_stages(size)
+        results['payments_vals_%s' % PAYMENTS_VALS_BENCHMARK_SIZE] = self._run_payments_vals_stages(
+            PAYMENTS_VALS_BENCHMARK_SIZE)
+        output = os.environ.get('BI_MULTI_INVOICE_PAYMENT_BENCHMARK_OUTPUT') or os.path.join(
+            tempfile.gettempdir(), 'bi_multi_invoice_payment_benchmark.json')
+        with open(output, 'w') as output_file:
+            json.dump({'sizes': results}, output_file, indent=2, sort_keys=True)
+        _logger.info("Multi invoice payment benchmark written in %s", output)
+
+        if os.environ.get('BI_MULTI_INVOICE_PAYMENT_BENCHMARK_UPDATE_BASELINE'):
+            with open(BASELINE_PATH, 'w') as baseline_file:
+                json.dump({'sizes': results}, baseline_file, indent=2, sort_keys=True)
+            return
+        with open(BASELINE_PATH) as baseline_file:
+            baseline = json.load(baseline_file)
+        self._compare_with_baseline(results, baseline.get('sizes', {}))
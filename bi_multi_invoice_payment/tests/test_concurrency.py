@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+import random
+import threading
+
+from psycopg2 import OperationalError, errorcodes
+
+from odoo import SUPERUSER_ID, api, fields
+from odoo.exceptions import UserError
+from odoo.tests import tagged
+from odoo.tests.common import TransactionCase
+
+# Deposit number of the registers, the batch payments using it (or starting
+# with it) are removed with the data of the tests.
+DEPOSIT_NUMBER = 'DEPOSIT/CONCURRENCY/TEST'
+
+
+@tagged('post_install', '-at_install')
+class TestPaymentConcurrency(TransactionCase):
+    '''Pay a shared pool of invoices from several transactions at once. The
+    data is committed from cursors of their own, the transaction of the test
+    is not used.
+
+    '''
+
+    def setUp(self):
+        super(TestPaymentConcurrency, self).setUp()
+        with self.registry.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            company = env.company
+            bank_journal = env['account.journal'].search([
+                ('company_id', '=', company.id), ('type', '=', 'bank')], limit=1)
+            sale_journal = env['account.journal'].search([
+                ('company_id', '=', company.id), ('type', '=', 'sale')], limit=1)
+            if not bank_journal or not sale_journal.default_account_id:
+                self.skipTest("No chart of accounts installed on the main company.")
+            partner = env['res.partner'].create({'name': 'Concurrent Payments'})
+            invoices = env['account.move'].create([{
+                'move_type': 'out_invoice',
+                'partner_id': partner.id,
+                'journal_id': sale_journal.id,
+                'invoice_date': fields.Date.from_string('2021-01-01'),
+                'invoice_line_ids': [(0, 0, {
+                    'name': 'Line %s' % index,
+                    'quantity': 1,
+                    'price_unit': 100.0,
+                    'account_id': sale_journal.default_account_id.id,
+                    'tax_ids': [(6, 0, [])],
+                })],
+            } for index in range(20)])
+            invoices.action_post()
+            self.partner_id = partner.id
+            self.bank_journal_id = bank_journal.id
+            self.invoice_ids = invoices.ids
+        self.addCleanup(self._remove_committed_data)
+
+    def _remove_committed_data(self):
+        with self.registry.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            payments = env['account.payment'].search([('partner_id', '=', self.partner_id)])
+            payments.filtered(lambda payment: payment.state != 'draft').action_draft()
+            payments.unlink()
+            registers = env['account.custom.payment.register'].search([
+                ('partner_id', '=', self.partner_id)])
+            # The lines refer to the invoices, they are removed first.
+            registers.register_line_ids.unlink()
+            registers.unlink()
+            env['account.batch.payment'].search([
+                ('journal_id', '=', self.bank_journal_id),
+                ('name', '=like', DEPOSIT_NUMBER + '%')]).unlink()
+            invoices = env['account.move'].browse(self.invoice_ids).exists()
+            invoices.button_draft()
+            invoices.with_context(force_delete=True).unlink()
+            env['res.partner'].browse(self.partner_id).unlink()
+
+    def _create_register(self, env, invoice_ids, amount=1.0, deposit_number=DEPOSIT_NUMBER):
+        '''Create a register paying the given amount of each invoice.'''
+        invoices = env['account.move'].browse(invoice_ids)
+        return env['account.custom.payment.register'].create({
+            'partner_id': self.partner_id,
+            'journal_id': self.bank_journal_id,
+            'deposit_number': deposit_number,
+            'check_number': 'CHECK/TEST',
+            'register_line_ids': [(0, 0, {
+                'move_id': invoice.id,
+                'amount_payment': amount,
+                'amount_balance': invoice.amount_residual - amount,
+            }) for invoice in invoices],
+        })
+
+    def test_lock_for_payment_fails_fast(self):
+        cr1 = self.registry.cursor()
+        cr2 = self.registry.cursor()
+        try:
+            invoices1 = api.Environment(cr1, SUPERUSER_ID, {})['account.move'].browse(self.invoice_ids[:10])
+            invoices2 = api.Environment(cr2, SUPERUSER_ID, {})['account.move'].browse(self.invoice_ids[5:15])
+            invoices1._lock_for_payment()
+            with self.assertRaises(UserError):
+                invoices2._lock_for_payment()
+            # The failed attempt leaves the transaction usable.
+            cr2.execute("SELECT 1")
+            cr1.rollback()
+            invoices2._lock_for_payment()
+        finally:
+            cr1.close()
+            cr2.close()
+
+    def test_parallel_registers(self):
+        '''Two registers paying the same invoices in parallel transactions
+        both create their payments: the amounts are kept on the payment
+        allocations and the invoices are neither written nor locked to pass
+        them to the posting.'''
+        invoice_ids = self.invoice_ids[:5]
+        with self.registry.cursor() as cr:
+            cr.execute("SELECT id, write_date FROM account_move WHERE id IN %s",
+                       [tuple(invoice_ids)])
+            write_dates = dict(cr.fetchall())
+
+        cr1 = self.registry.cursor()
+        cr2 = self.registry.cursor()
+        try:
+            # Waiting for a row of the other transaction fails instead of
+            # blocking the test.
+            cr1.execute("SET LOCAL lock_timeout = '5s'")
+            cr2.execute("SET LOCAL lock_timeout = '5s'")
+            env1 = api.Environment(cr1, SUPERUSER_ID, {})
+            env2 = api.Environment(cr2, SUPERUSER_ID, {})
+            register1 = self._create_register(env1, invoice_ids, amount=10.0)
+            register2 = self._create_register(env2, invoice_ids, amount=20.0)
+            # Both transactions are open at the same time.
+            register1.create_payments()
+            register2.create_payments()
+            cr2.commit()
+            cr1.commit()
+        finally:
+            cr1.close()
+            cr2.close()
+
+        with self.registry.cursor() as cr:
+            cr.execute("SELECT id, write_date FROM account_move WHERE id IN %s",
+                       [tuple(invoice_ids)])
+            self.assertEqual(dict(cr.fetchall()), write_dates)
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            allocations = env['account.payment.allocation'].search([('move_id', 'in', invoice_ids)])
+            self.assertEqual(len(allocations), 10)
+            for register, amount in ((register1, 10.0), (register2, 20.0)):
+                register_allocations = allocations.filtered(
+                    lambda allocation: allocation.register_id.id == register.id)
+                self.assertEqual(sorted(register_allocations.move_id.ids), sorted(invoice_ids))
+                self.assertEqual(set(register_allocations.mapped('amount')), {amount})
+            invoices = env['account.move'].browse(invoice_ids)
+            self.assertEqual(set(invoices.mapped('amount_residual')), {100.0})
+
+    def test_parallel_payments_stress(self):
+        '''Several workers pay random overlapping subsets of the pool: each
+        one creates the payments of a register, then posts them in another
+        transaction, which locks the invoices, reconciles them and adds the
+        payments to the deposit of the worker. A worker finding its invoices
+        locked or changed by another one gets the UserError of
+        _lock_for_payment, there must be no deadlock nor serialization
+        failure and the invoices must be paid by the posted amounts.'''
+        errors = []
+        results = {'paid': 0, 'busy': 0}
+        results_lock = threading.Lock()
+
+        def worker(seed):
+            rnd = random.Random(seed)
+            deposit_number = '%s/%s' % (DEPOSIT_NUMBER, seed)
+            with api.Environment.manage():
+                for _round in range(5):
+                    invoice_ids = rnd.sample(self.invoice_ids, 8)
+                    try:
+                        with self.registry.cursor() as cr:
+                            env = api.Environment(cr, SUPERUSER_ID, {})
+                            register = self._create_register(
+                                env, invoice_ids, deposit_number=deposit_number)
+                            action = register.create_payments()
+                            payment_ids = env['account.payment'].search(action['domain']).ids
+                        # Posted from another request, like from the list of
+                        # the payments.
+                        with self.registry.cursor() as cr:
+                            env = api.Environment(cr, SUPERUSER_ID, {})
+                            env['account.payment'].browse(payment_ids).action_post()
+                        outcome = 'paid'
+                    except UserError:
+                        outcome = 'busy'
+                    except OperationalError as e:
+                        errors.append(e.pgcode)
+                        continue
+                    except Exception as e:
+                        errors.append(repr(e))
+                        continue
+                    with results_lock:
+                        results[outcome] += 1
+
+        threads = [threading.Thread(target=worker, args=(seed,)) for seed in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=300)
+        self.assertFalse(any(thread.is_alive() for thread in threads), "A worker is stuck.")
+        self.assertNotIn(errorcodes.DEADLOCK_DETECTED, errors)
+        self.assertNotIn(errorcodes.SERIALIZATION_FAILURE, errors)
+        self.assertFalse(errors)
+        self.assertTrue(results['paid'])
+
+        with self.registry.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            allocations = env['account.payment.allocation'].search([
+                ('move_id', 'in', self.invoice_ids),
+                ('payment_id.state', '=', 'posted')])
+            for payment in allocations.payment_id:
+                self.assertEqual(payment.batch_payment_id.name, payment.deposit_number)
+            for invoice in env['account.move'].browse(self.invoice_ids):
+                paid = sum(allocations.filtered(lambda allocation: allocation.move_id == invoice).mapped('amount'))
+                self.assertAlmostEqual(invoice.amount_residual, 100.0 - paid)
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+from odoo.tests import tagged
+
+from .common import MultiInvoicePaymentCommon
+
+
+@tagged('post_install', '-at_install')
+class TestDiscountCreditNotes(MultiInvoicePaymentCommon):
+
+    @classmethod
+    def setUpClass(cls, chart_template_ref=None):
+        super(TestDiscountCreditNotes, cls).setUpClass(chart_template_ref=chart_template_ref)
+        cls.partner = cls.env['res.partner'].create({'name': 'Discount'})
+        cls.invoices = cls._create_invoices(cls.partner, 2)
+        # An invoice with taxes: the discount has none.
+        cls.taxed_invoice = cls._create_invoices(cls.partner, 1, post=False)
+        cls.taxed_invoice.invoice_line_ids.tax_ids = cls.company_data['default_tax_sale']
+        cls.taxed_invoice.action_post()
+
+    def test_create_discount_credit_notes(self):
+        invoices = self.invoices + self.taxed_invoice
+        register = self._create_register(invoices, amount=90.0)
+        lines = register.register_line_ids
+        lines.write({'discount': True})
+        credit_notes = register.create_discount_credit_notes(lines)
+
+        self.assertEqual(len(credit_notes), 3)
+        revenue_account = self.company_data['default_account_revenue']
+        for line, credit_note in zip(lines, credit_notes):
+            invoice = line.move_id
+            discount = line.amount_balance
+            receivable_line = invoice.line_ids.filtered(
+                lambda l: l.account_internal_type == 'receivable')
+            self.assertRecordValues(credit_note, [{
+                'move_type': 'out_refund',
+                'state': 'draft',
+                'partner_id': self.partner.id,
+                'reversed_entry_id': invoice.id,
+                'journal_id': invoice.journal_id.id,
+                'currency_id': invoice.currency_id.id,
+                'amount_total': discount,
+                'amount_tax': 0.0,
+            }])
+            self.assertRecordValues(credit_note.line_ids.sorted('debit', reverse=True), [
+                {'account_id': revenue_account.id, 'debit': discount, 'credit': 0.0,
+                 'amount_currency': discount, 'tax_ids': [], 'tax_line_id': False},
+                {'account_id': receivable_line.account_id.id, 'debit': 0.0, 'credit': discount,
+                 'amount_currency': -discount, 'tax_ids': [], 'tax_line_id': False},
+            ])
+            self.assertEqual(sum(credit_note.line_ids.mapped('balance')), 0.0)
+        # The credit notes can be posted and pay the discount of the invoices.
+        credit_notes.action_post()
+        self.assertEqual(credit_notes.mapped('amount_residual'), lines.mapped('amount_balance'))
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+from odoo import fields
+from odoo.tests import tagged
+
+from .common import MultiInvoicePaymentCommon
+
+
+@tagged('post_install', '-at_install')
+class TestForeignCurrency(MultiInvoicePaymentCommon):
+    '''Pay EUR invoices from a USD company. 1 USD is 2 EUR when the invoices
+    are issued and 2.5 EUR when they are paid: an invoice of 200 EUR is
+    100 USD and its payment 80 USD, the 20 USD left are an exchange loss.
+
+    '''
+
+    @classmethod
+    def setUpClass(cls, chart_template_ref=None):
+        super(TestForeignCurrency, cls).setUpClass(chart_template_ref=chart_template_ref)
+        cls.company = cls.company_data['company']
+        cls.eur = cls.env.ref('base.EUR')
+        cls.eur.active = True
+        cls.env['res.currency.rate'].create([
+            {'name': '2021-01-01', 'rate': 2.0, 'currency_id': cls.eur.id, 'company_id': cls.company.id},
+            {'name': '2021-06-01', 'rate': 2.5, 'currency_id': cls.eur.id, 'company_id': cls.company.id},
+        ])
+        cls.partner = cls.env['res.partner'].create({'name': 'Foreign Currency'})
+        cls.invoices = cls._create_invoices(cls.partner, 2, amount=200.0, currency_id=cls.eur.id)
+        cls.discount_invoice = cls._create_invoices(cls.partner, 1, amount=200.0, currency_id=cls.eur.id)
+
+    def _pay(self, register):
+        action = register.create_payments()
+        payments = self.env['account.payment'].search(action['domain'])
+        payments.action_post()
+        return payments
+
+    def _assert_balanced(self, moves):
+        for move in moves:
+            self.assertTrue(self.company.currency_id.is_zero(sum(move.line_ids.mapped('balance'))))
+
+    def test_pay_foreign_currency_invoices(self):
+        self.assertNotEqual(self.company.currency_id, self.eur)
+        self.assertRecordValues(self.invoices, [{'amount_residual': 200.0, 'amount_residual_signed': 100.0}] * 2)
+        register = self._create_register(self.invoices, payment_date=fields.Date.from_string('2021-06-01'))
+        self.assertEqual(register.currency_id, self.eur)
+        payments = self._pay(register)
+
+        self.assertEqual(payments.currency_id, self.eur)
+        self.assertEqual(sum(payments.mapped('amount')), 400.0)
+        self._assert_balanced(payments.move_id)
+        receivable_lines = payments.move_id.line_ids.filtered(
+            lambda line: line.account_internal_type == 'receivable')
+        self.assertEqual(sorted(receivable_lines.mapped('amount_currency')), [-200.0, -200.0])
+        self.assertEqual(sorted(receivable_lines.mapped('balance')), [-80.0, -80.0])
+
+        # Fully paid in EUR, with one partial of 80 USD by invoice.
+        self.assertEqual(self.invoices.mapped('amount_residual'), [0.0, 0.0])
+        self.assertTrue(all(state in ('paid', 'in_payment') for state in self.invoices.mapped('payment_state')))
+        invoice_lines = self.invoices.line_ids.filtered(
+            lambda line: line.account_internal_type == 'receivable')
+        for invoice_line in invoice_lines:
+            self.assertRecordValues(invoice_line.matched_credit_ids, [{
+                'amount': 80.0,
+                'debit_amount_currency': 200.0,
+                'credit_amount_currency': 200.0,
+                'debit_currency_id': self.eur.id,
+                'credit_currency_id': self.eur.id,
+            }])
+        self.assertTrue(all(invoice_lines.mapped('reconciled')))
+        self.assertTrue(all(invoice_lines.mapped('full_reconcile_id')))
+
+        # The 20 USD left on each invoice are an exchange loss, posted.
+        exchange_moves = invoice_lines.full_reconcile_id.exchange_move_id
+        self.assertEqual(len(exchange_moves), 2)
+        self.assertEqual(set(exchange_moves.mapped('state')), {'posted'})
+        self._assert_balanced(exchange_moves)
+        loss_lines = exchange_moves.line_ids.filtered(
+            lambda line: line.account_id == self.company.expense_currency_exchange_account_id)
+        self.assertEqual(loss_lines.mapped('balance'), [20.0, 20.0])
+        self.assertTrue(all(line.company_currency_id.is_zero(line.amount_residual)
+                            for line in invoice_lines + receivable_lines))
+
+    def test_discount_credit_note_foreign_currency(self):
+        register = self._create_register(self.discount_invoice, amount=150.0,
+                                         payment_date=fields.Date.from_string('2021-06-01'))
+        line = register.register_line_ids
+        line.discount = True
+        self._pay(register)
+
+        # The credit note is at the rate of its date: 50 EUR are 20 USD.
+        credit_note = self.env['account.move'].search([('reversed_entry_id', '=', self.discount_invoice.id)])
+        self.assertEqual(credit_note.currency_id, self.eur)
+        self.assertEqual(credit_note.amount_total, 50.0)
+        self._assert_balanced(credit_note)
+        self.assertEqual(sorted(credit_note.line_ids.mapped('amount_currency')), [-50.0, 50.0])
+        self.assertEqual(sorted(credit_note.line_ids.mapped('balance')), [-20.0, 20.0])
+        # The payment paid 150 EUR of the invoice.
+        self.assertEqual(self.discount_invoice.amount_residual, 50.0)
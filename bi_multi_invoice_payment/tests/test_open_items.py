@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+from odoo.tests import tagged
+
+from .common import MultiInvoicePaymentCommon
+
+
+@tagged('post_install', '-at_install')
+class TestOpenItems(MultiInvoicePaymentCommon):
+
+    @classmethod
+    def setUpClass(cls, chart_template_ref=None):
+        super(TestOpenItems, cls).setUpClass(chart_template_ref=chart_template_ref)
+        cls.partner = cls.env['res.partner'].create({'name': 'Open Items'})
+        cls.invoices = cls._create_invoices(cls.partner, 5)
+
+    def test_open_items_follow_invoices(self):
+        OpenItem = self.env['account.move.open.item']
+        self.assertEqual(OpenItem.search([('partner_id', '=', self.partner.id)]).move_id,
+                         self.invoices)
+        self.invoices[0].button_draft()
+        self.assertEqual(OpenItem.search([('partner_id', '=', self.partner.id)]).move_id,
+                         self.invoices[1:])
+
+    def test_open_invoices_search_plan(self):
+        '''The search of the register is one range scan of the open items
+        index, giving the rows in the order they are loaded. The tables of
+        the tests are too small for the planner to prefer an index over a
+        sequential scan, so the other access paths are disabled: the plan
+        shows the index can filter and order the open items on its own.'''
+        register = self.env['account.custom.payment.register'].new({
+            'partner_id': self.partner.id,
+            'journal_id': self.bank_journal.id,
+        })
+        OpenItem = self.env['account.move.open.item']
+        query = OpenItem._where_calc(register._get_open_invoices_domain())
+        OpenItem._apply_ir_rules(query, 'read')
+        order_by = OpenItem._generate_order_by(None, query)
+        from_clause, where_clause, params = query.get_sql()
+        self.env['base'].flush()
+        self.cr.execute("ANALYZE account_move_open_item")
+        self.cr.execute("SET LOCAL enable_seqscan = off")
+        self.cr.execute("SET LOCAL enable_bitmapscan = off")
+        self.cr.execute('EXPLAIN SELECT "account_move_open_item".id FROM %s WHERE %s%s LIMIT %s'
+                        % (from_clause, where_clause, order_by,
+                           register._get_open_invoices_page_size() + 1), params)
+        plan = '\n'.join(row[0] for row in self.cr.fetchall())
+        self.assertIn('account_move_open_item_partner_due_index', plan)
+        self.assertNotIn('Sort', plan)
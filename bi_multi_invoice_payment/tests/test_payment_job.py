@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+from unittest.mock import patch
+
+from odoo.exceptions import UserError
+from odoo.tests import tagged
+
+from .common import MultiInvoicePaymentCommon
+
+
+@tagged('post_install', '-at_install')
+class TestPaymentJob(MultiInvoicePaymentCommon):
+
+    @classmethod
+    def setUpClass(cls, chart_template_ref=None):
+        super(TestPaymentJob, cls).setUpClass(chart_template_ref=chart_template_ref)
+        cls.env['ir.config_parameter'].sudo().set_param(
+            'bi_multi_invoice_payment.payment_job_chunk_size', 2)
+        cls.partner = cls.env['res.partner'].create({'name': 'Payment Job'})
+        cls.invoices = cls._create_invoices(cls.partner, 5)
+
+    def _run_job(self, register, fail_on_call=None):
+        '''Run the scheduled action and return the lines paid by each call of
+        _create_payments_for_lines. The call number fail_on_call raises an
+        error instead.'''
+        Register = type(self.env['account.custom.payment.register'])
+        create_payments_for_lines = Register._create_payments_for_lines
+        chunks = []
+
+        def _create_payments_for_lines(self, lines):
+            chunks.append(lines)
+            if len(chunks) == fail_on_call:
+                raise UserError("Payment failed")
+            return create_payments_for_lines(self, lines)
+
+        with patch.object(Register, '_create_payments_for_lines', _create_payments_for_lines):
+            register._cron_process_payment_registers()
+        return chunks
+
+    def test_payment_job_chunks(self):
+        register = self._create_register(self.invoices)
+        register.action_create_payments_async()
+        self.assertEqual(register.state, 'queued')
+
+        chunks = self._run_job(register)
+        self.assertEqual([len(lines) for lines in chunks], [2, 2, 1])
+        self.assertEqual(register.state, 'posted')
+        self.assertTrue(all(register.register_line_ids.mapped('processed')))
+        self.assertEqual(register.allocation_ids.move_id, self.invoices)
+
+    def test_payment_job_failure_and_retry(self):
+        register = self._create_register(self.invoices)
+        lines = register.register_line_ids.sorted('id')
+        register.action_create_payments_async()
+
+        self._run_job(register, fail_on_call=2)
+        self.assertEqual(register.state, 'failed')
+        self.assertIn("Payment failed", register.job_error)
+        # The first chunk is kept, the failed one is rolled back.
+        self.assertEqual(lines.mapped('processed'), [True, True, False, False, False])
+        self.assertEqual(register.allocation_ids.move_id, lines[:2].move_id)
+
+        register.action_retry_payments()
+        self.assertEqual(register.state, 'queued')
+        self.assertFalse(register.job_error)
+        chunks = self._run_job(register)
+        self.assertEqual([lines.ids for lines in chunks], [lines[2:4].ids, lines[4:].ids])
+        self.assertEqual(register.state, 'posted')
+        self.assertTrue(all(lines.mapped('processed')))
+        # Each invoice is paid once.
+        self.assertEqual(sorted(register.allocation_ids.move_id.ids), sorted(self.invoices.ids))
+        self.assertEqual(len(register.allocation_ids), 5)
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+import re
+
+from odoo import fields
+from odoo.tests import tagged
+
+from .common import MultiInvoicePaymentCommon
+
+
+@tagged('post_install', '-at_install')
+class TestPaymentNames(MultiInvoicePaymentCommon):
+
+    def _create_sequence(self, implementation, use_date_range):
+        return self.env['ir.sequence'].create({
+            'name': 'Payment Names',
+            'implementation': implementation,
+            'use_date_range': use_date_range,
+            'prefix': 'PAY/%(range_year)s/' if use_date_range else 'PAY/',
+            'padding': 4,
+            'number_increment': 2,
+            'company_id': self.env.company.id,
+        })
+
+    def test_reserve_sequence_names(self):
+        '''The names reserved at once are the ones as many _next() calls
+        give, for the standard and the no gap sequences, with and without
+        date ranges.'''
+        Payment = self.env['account.payment']
+        date = fields.Date.from_string('2021-06-01')
+        for implementation in ('standard', 'no_gap'):
+            for use_date_range in (False, True):
+                with self.subTest(implementation=implementation, use_date_range=use_date_range):
+                    sequence = self._create_sequence(implementation, use_date_range)
+                    reference = self._create_sequence(implementation, use_date_range)
+                    sequence_date = date if use_date_range else False
+                    names = Payment._reserve_sequence_names(sequence, 5, sequence_date)
+                    names += Payment._reserve_sequence_names(sequence, 1, sequence_date)
+                    names += Payment._reserve_sequence_names(sequence, 3, sequence_date)
+                    expected = [reference._next(sequence_date=sequence_date) for dummy in range(9)]
+                    self.assertEqual(names, expected)
+                    self.assertEqual(len(set(names)), 9)
+
+    def test_reserve_sequence_names_query_count(self):
+        '''Reserving 100 names costs as many queries as reserving one.'''
+        Payment = self.env['account.payment']
+        for implementation in ('standard', 'no_gap'):
+            with self.subTest(implementation=implementation):
+                sequence = self._create_sequence(implementation, True)
+                date = fields.Date.from_string('2021-06-01')
+                # The date range is created by the first reservation.
+                Payment._reserve_sequence_names(sequence, 1, date)
+                query_count = self.cr.sql_log_count
+                Payment._reserve_sequence_names(sequence, 1, date)
+                single_count = self.cr.sql_log_count - query_count
+                with self.assertQueryCount(single_count):
+                    Payment._reserve_sequence_names(sequence, 100, date)
+
+    def test_post_ungrouped_register_names(self):
+        '''An ungrouped register creates one payment by invoice, posted with
+        unique and consecutive names.'''
+        partner = self.env['res.partner'].create({'name': 'Payment Names'})
+        invoices = self._create_invoices(partner, 4)
+        register = self._create_register(invoices, group_payment=False)
+        action = register.create_payments()
+        payments = self.env['account.payment'].search(action['domain'])
+        self.assertEqual(len(payments), 4)
+        payments.action_post()
+
+        names = payments.sorted('id').mapped('name')
+        self.assertEqual(len(set(names)), 4)
+        numbers = [int(re.search(r'(\d+)$', name).group(1)) for name in names]
+        self.assertEqual(numbers, list(range(numbers[0], numbers[0] + 4)))
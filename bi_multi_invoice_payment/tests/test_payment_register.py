@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+from odoo.exceptions import UserError
+from odoo.tests import tagged
+
+from .common import MultiInvoicePaymentCommon
+
+
+@tagged('post_install', '-at_install')
+class TestPaymentRegister(MultiInvoicePaymentCommon):
+
+    def test_check_no_invoices(self):
+        Register = self.env['account.custom.payment.register']
+        with self.assertRaises(UserError):
+            Register._check_invoices([])
+        # The transaction is still usable.
+        self.assertFalse(Register.search([('id', '=', 0)]))
+
+    def test_autofill_lines(self):
+        partner = self.env['res.partner'].create({'name': 'Autofill'})
+        invoices = self._create_invoices(partner, 3, amount=100.0)
+        register = self._create_register(invoices, amount=10.0)
+        lines = register.register_line_ids
+        lines[0].discount = True
+        self.assertEqual(register.total_invoice_amount, 30.0)
+        self.assertEqual(register.total_discount_balance, 90.0)
+
+        register.autofill_lines()
+        self.assertRecordValues(lines, [
+            {'amount_payment': 100.0, 'amount_balance': 0.0, 'percent_balance': 0.0}] * 3)
+        # The totals depending on the lines are recomputed.
+        self.assertEqual(register.total_invoice_amount, 300.0)
+        self.assertEqual(register.total_discount_balance, 0.0)
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+import random
+from unittest.mock import patch
+
+from odoo.tests import tagged
+
+from .common import MultiInvoicePaymentCommon
+
+
+def reference_reconcile_lines(debit_moves, credit_moves, payment_amounts, customer_payment):
+    '''The pairing loop of the original _custom_reconcile_lines, reconciling
+    on amount_residual. Its writes of the residual amounts on the journal
+    items are left out: they don't change the partials nor the remaining
+    lines.
+
+    :return: A tuple (partial values in creation order, remaining lines).
+    '''
+    currency_line_ids = set((debit_moves + credit_moves).filtered('currency_id').ids)
+    to_create = []
+    while (debit_moves and credit_moves):
+        debit_move = debit_moves[0]
+        credit_move = credit_moves[0]
+        company_currency = debit_move.company_id.currency_id
+        if customer_payment:
+            amount_reconcile = payment_amounts[debit_move.move_id.id]
+        else:
+            amount_reconcile = payment_amounts[credit_move.move_id.id]
+        if customer_payment:
+            debit_moves -= debit_move
+        if not customer_payment:
+            credit_moves -= credit_move
+        currency = False
+        amount_reconcile_currency = 0
+        if bool(debit_move.currency_id) != bool(credit_move.currency_id):
+            currency = debit_move.currency_id or credit_move.currency_id
+            currency_date = debit_move.currency_id and credit_move.date or debit_move.date
+            amount_reconcile_currency = company_currency._convert(
+                amount_reconcile, currency, debit_move.company_id, currency_date)
+            currency = currency.id
+        to_create.append({
+            'debit_move_id': debit_move.id,
+            'credit_move_id': credit_move.id,
+            'amount': amount_reconcile,
+            'amount_currency': amount_reconcile_currency,
+            'currency_id': currency,
+        })
+    # The partials between lines both having a currency were created first.
+    not_cash_basis_subjected = [vals for vals in to_create if vals['debit_move_id'] in currency_line_ids
+                                and vals['credit_move_id'] in currency_line_ids]
+    cash_basis_subjected = [vals for vals in to_create if vals not in not_cash_basis_subjected]
+    return not_cash_basis_subjected + cash_basis_subjected, debit_moves + credit_moves
+
+
+@tagged('post_install', '-at_install')
+class TestCustomReconcileLines(MultiInvoicePaymentCommon):
+
+    @classmethod
+    def setUpClass(cls, chart_template_ref=None):
+        super(TestCustomReconcileLines, cls).setUpClass(chart_template_ref=chart_template_ref)
+        # Not a receivable/payable account: no cash basis entries.
+        cls.reconcile_account = cls.env['account.account'].create({
+            'name': 'Reconcile Test',
+            'code': 'RECTEST',
+            'user_type_id': cls.env.ref('account.data_account_type_current_assets').id,
+            'reconcile': True,
+            'company_id': cls.env.company.id,
+        })
+        counterpart_account = cls.company_data['default_account_revenue']
+        rnd = random.Random(0)
+        move_vals_list = []
+        for index in range(40):
+            amount = round(rnd.uniform(1, 1000), 2)
+            debit = index % 2 == 0
+            move_vals_list.append({
+                'move_type': 'entry',
+                'journal_id': cls.company_data['default_journal_misc'].id,
+                'date': '2021-01-%02d' % (index % 28 + 1),
+                'line_ids': [
+                    (0, 0, {'account_id': cls.reconcile_account.id,
+                            'debit': debit and amount or 0.0,
+                            'credit': not debit and amount or 0.0}),
+                    (0, 0, {'account_id': counterpart_account.id,
+                            'debit': not debit and amount or 0.0,
+                            'credit': debit and amount or 0.0}),
+                ],
+            })
+        lines = cls.env['account.move'].create(move_vals_list).line_ids.filtered(
+            lambda line: line.account_id == cls.reconcile_account)
+        cls.debit_lines = lines.filtered(lambda line: line.debit)
+        cls.credit_lines = lines.filtered(lambda line: line.credit)
+
+    def _run_custom_reconcile_lines(self, debit_moves, credit_moves, payment_amounts, customer_payment):
+        '''Run _custom_reconcile_lines, recording the partial values instead
+        of creating them.'''
+        created = []
+
+        def create(model, vals_list):
+            created.extend([vals_list] if isinstance(vals_list, dict) else vals_list)
+            return model.browse()
+
+        AccountMoveLine = self.env['account.move.line']
+        with patch.object(type(self.env['account.partial.reconcile']), 'create', create):
+            remaining = AccountMoveLine._custom_reconcile_lines(
+                debit_moves, credit_moves, 'amount_residual', payment_amounts, customer_payment)
+        return created, remaining
+
+    def test_custom_reconcile_lines_equivalence(self):
+        for seed in range(200):
+            rnd = random.Random(seed)
+            debit_moves = self.env['account.move.line'].concat(*rnd.sample(
+                list(self.debit_lines), rnd.randint(0, len(self.debit_lines))))
+            credit_moves = self.env['account.move.line'].concat(*rnd.sample(
+                list(self.credit_lines), rnd.randint(0, len(self.credit_lines))))
+            payment_amounts = {
+                move_id: round(rnd.uniform(0.01, 1000), 2)
+                for move_id in (self.debit_lines + self.credit_lines).move_id.ids}
+            customer_payment = rnd.random() < 0.5
+            with self.subTest(seed=seed):
+                expected, expected_remaining = reference_reconcile_lines(
+                    debit_moves, credit_moves, payment_amounts, customer_payment)
+                created, remaining = self._run_custom_reconcile_lines(
+                    debit_moves, credit_moves, payment_amounts, customer_payment)
+                self.assertEqual(created, expected)
+                self.assertEqual(remaining.ids, expected_remaining.ids)
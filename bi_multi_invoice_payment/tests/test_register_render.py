@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+from odoo.tests import tagged
+
+from .common import MultiInvoicePaymentCommon
+
+# Fields read by the form of the register and by the list of its lines.
+REGISTER_FIELDS = ['state', 'partner_id', 'journal_id', 'currency_id',
+                   'register_line_ids', 'total_balance', 'total_invoice_amount']
+LINE_FIELDS = ['move_id', 'currency_id', 'partner_id', 'discount', 'amount_total',
+               'amount_residual', 'amount_payment', 'amount_balance',
+               'percent_balance', 'processed']
+
+
+@tagged('post_install', '-at_install')
+class TestRegisterRender(MultiInvoicePaymentCommon):
+
+    def _render(self, register):
+        '''Read the register and its lines like the form view does, with an
+        empty cache.'''
+        register.invalidate_cache()
+        values = register.read(REGISTER_FIELDS)[0]
+        self.env['account.payment.register.line'].browse(values['register_line_ids']).read(LINE_FIELDS)
+
+    def test_render_query_count(self):
+        partner = self.env['res.partner'].create({'name': 'Render'})
+        small_register = self._create_register(self._create_invoices(partner, 2), amount=10.0)
+        large_register = self._create_register(self._create_invoices(partner, 50), amount=10.0)
+        self.env['base'].flush()
+
+        # The first render fills the caches of the registry.
+        self._render(small_register)
+        query_count = self.cr.sql_log_count
+        self._render(small_register)
+        small_count = self.cr.sql_log_count - query_count
+
+        lines = large_register.register_line_ids
+        write_dates = lines.mapped('write_date')
+        with self.assertQueryCount(small_count):
+            self._render(large_register)
+        # Reading the lines never writes them.
+        self.env['base'].flush()
+        lines.invalidate_cache()
+        self.assertEqual(lines.mapped('write_date'), write_dates)
+        self.assertEqual(lines.mapped('amount_residual'), [100.0] * 50)
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+
+from odoo.tests import tagged
+
+from .common import MultiInvoicePaymentCommon
+
+CAMT_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8"?>
+%(doctype)s
+<Document xmlns="urn:iso:std:iso:20022:tech:xsd:camt.054.001.02">
+  <BkToCstmrDbtCdtNtfctn>
+    <Ntfctn>
+      <Ntry>
+        <NtryDtls>
+          <TxDtls>
+            <RmtInf>
+              <Strd>
+                <RfrdDocInf><Nb>%(reference)s</Nb></RfrdDocInf>
+                <RfrdDocAmt><RmtdAmt Ccy="USD">%(amount)s</RmtdAmt></RfrdDocAmt>
+              </Strd>
+            </RmtInf>
+          </TxDtls>
+        </NtryDtls>
+      </Ntry>
+    </Ntfctn>
+  </BkToCstmrDbtCdtNtfctn>
+</Document>
+'''
+
+
+@tagged('post_install', '-at_install')
+class TestRemittanceImport(MultiInvoicePaymentCommon):
+
+    @classmethod
+    def setUpClass(cls, chart_template_ref=None):
+        super(TestRemittanceImport, cls).setUpClass(chart_template_ref=chart_template_ref)
+        cls.partner = cls.env['res.partner'].create({'name': 'Remittance'})
+        cls.other_partner = cls.env['res.partner'].create({'name': 'Other Remittance'})
+        cls.invoices = cls._create_invoices(cls.partner, 3)
+        cls.other_invoice = cls._create_invoices(cls.other_partner, 1)
+        # Posted once, so it has a name, then reset to draft.
+        cls.draft_invoice = cls._create_invoices(cls.partner, 1)
+        cls.draft_invoice.button_draft()
+        cls.register = cls.env['account.custom.payment.register'].create({
+            'partner_id': cls.partner.id,
+            'journal_id': cls.bank_journal.id,
+            'deposit_number': 'DEPOSIT/TEST',
+            'check_number': 'CHECK/TEST',
+        })
+
+    def test_parse_remittance_amount(self):
+        parse = self.env['account.custom.payment.register']._parse_remittance_amount
+        for value, amount in [
+            ('10', 10.0), ('+7', 7.0), (' 10.50 ', 10.5), ('10,50', 10.5),
+            ('0,123', 0.123), ('1.234,56', 1234.56), ('1,234.56', 1234.56),
+            ('1.234.567', 1234567.0), ('1,234,567.89', 1234567.89), ('1 234,56', 1234.56),
+        ]:
+            with self.subTest(value=value):
+                self.assertEqual(parse(value), amount)
+        for value in ['', 'abc', 'nan', 'inf', '-inf', '1e3', '0x10', '1,2,3', '1.234.56',
+                      '12,34.5', '1.23,4', '1,234', ',5', '5.', '-5', '0', '0.00']:
+            with self.subTest(value=value):
+                with self.assertRaises(ValueError):
+                    parse(value)
+        self.assertEqual(parse('0.00', allow_zero=True), 0.0)
+
+    def test_import_remittance_chunk(self):
+        rows = [
+            {'row': 1, 'reference': self.invoices[0].name, 'amount': '40.00', 'discount': False},
+            {'row': 2, 'reference': self.invoices[1].name, 'amount': '1,234', 'discount': False},
+            {'row': 3, 'reference': 'UNKNOWN', 'amount': '10', 'discount': False},
+            {'row': 4, 'reference': self.draft_invoice.name, 'amount': '10', 'discount': False},
+            {'row': 5, 'reference': self.invoices[0].name, 'amount': '10', 'discount': False},
+            {'row': 6, 'reference': self.other_invoice.name, 'amount': '10', 'discount': False},
+            {'row': 7, 'reference': self.invoices[2].name, 'amount': '100', 'discount': True},
+            {'row': 8, 'reference': self.invoices[1].name, 'amount': '10',
+             'discount': False, 'error': 'Invalid discount x'},
+        ]
+        imported_move_ids = set()
+        count, rejected = self.register._import_remittance_chunk(rows, imported_move_ids)
+
+        self.assertEqual(count, 2)
+        self.assertEqual(imported_move_ids, {self.invoices[0].id, self.invoices[2].id})
+        self.assertEqual([(row['row'], error) for row, error in rejected], [
+            (2, 'Invalid amount 1,234'),
+            (3, 'Invoice not found'),
+            (4, 'Invoice not open'),
+            (5, 'Invoice already in the register'),
+            (6, 'Invoice of another partner'),
+            (8, 'Invalid discount x'),
+        ])
+        lines = self.register.register_line_ids.sorted(lambda line: line.move_id.id)
+        self.assertRecordValues(lines, [
+            {'move_id': self.invoices[0].id, 'amount_payment': 40.0,
+             'amount_balance': 60.0, 'discount': False},
+            {'move_id': self.invoices[2].id, 'amount_payment': 100.0,
+             'amount_balance': 0.0, 'discount': True},
+        ])
+
+    def _camt(self, reference, amount, doctype=''):
+        return (CAMT_TEMPLATE % {
+            'doctype': doctype,
+            'reference': reference,
+            'amount': amount,
+        }).encode()
+
+    def test_camt_external_entities_not_resolved(self):
+        secret = 'SECRET-%s' % os.getpid()
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as secret_file:
+            secret_file.write(secret)
+        self.addCleanup(os.remove, secret_file.name)
+        doctype = '<!DOCTYPE Document [<!ENTITY secret SYSTEM "file://%s">]>' % secret_file.name
+        data = self._camt('INV/&secret;', '10.00', doctype=doctype)
+
+        rows = list(self.env['account.custom.payment.register']._read_remittance_camt(data))
+        self.assertEqual(len(rows), 1)
+        self.assertNotIn(secret, rows[0]['reference'])
+        self.assertEqual(rows[0]['amount'], '10.00')